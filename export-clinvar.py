@@ -20,505 +20,18 @@
 # Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301
 # USA
 
-import csv
 import sys
-import time
-from collections import OrderedDict
-from datetime import date
-from datetime import timedelta
-from dateutil.parser import parse as parsedate
 from getopt import getopt
 from getpass import getpass
 from phenotipsbot import PhenoTipsBot
+from phenotipsbot import begin_export
+from phenotipsbot import get_clinvar_data
+from phenotipsbot import parse_since
+from phenotipsbot import recount_clinvar_data
+from phenotipsbot import write_clinvar_files
+from phenotipsbot import write_export_state
 from sys import stdout
 
-def get_clinvar_data(bot, patient_ids, gene, progress_callback):
-    start_time = time.time()
-    count = 0
-
-    clinvar_data = OrderedDict()
-
-    for patient_id in patient_ids:
-        count += 1
-        progress_callback(count)
-
-        clinvar_variant_nums = bot.list_objects(patient_id, 'PhenoTips.ClinVarVariantClass')
-        if len(clinvar_variant_nums) == 0:
-            continue
-
-        patient_obj = bot.get(patient_id)
-
-        for clinvar_variant_num in clinvar_variant_nums:
-            clinvar_variant_obj = bot.get_object(patient_id, 'PhenoTips.ClinVarVariantClass', clinvar_variant_num)
-            gene_symbol = clinvar_variant_obj.get('gene_symbol')
-
-            if gene and (not gene_symbol or not gene in gene_symbol.upper().split(';')):
-                continue
-
-            #we aggregate all fields except for these
-            clinvar_data_key = (
-                clinvar_variant_obj['reference_sequence']    if 'reference_sequence'    in clinvar_variant_obj else None,
-                clinvar_variant_obj['hgvs']                  if 'hgvs'                  in clinvar_variant_obj else None,
-                clinvar_variant_obj['cis_or_trans']          if 'cis_or_trans'          in clinvar_variant_obj else None,
-                clinvar_variant_obj['location']              if 'location'              in clinvar_variant_obj else None,
-                patient_obj['omim_id']                       if 'omim_id'               in patient_obj         else None,
-                clinvar_variant_obj['condition_category']    if 'condition_category'    in clinvar_variant_obj else None,
-                clinvar_variant_obj['clinical_significance'] if 'clinical_significance' in clinvar_variant_obj else None,
-                clinvar_variant_obj['collection_method']     if 'collection_method'     in clinvar_variant_obj else None,
-                clinvar_variant_obj['allele_origin']         if 'allele_origin'         in clinvar_variant_obj else None,
-                clinvar_variant_obj['tissue']                if 'tissue'                in clinvar_variant_obj else None,
-                patient_obj        ['case_or_control']       if 'case_or_control'       in patient_obj         else None,
-            )
-
-            if not clinvar_data_key in clinvar_data:
-                clinvar_data[clinvar_data_key] = []
-
-            clinvar_data[clinvar_data_key].append((patient_obj, clinvar_variant_obj))
-
-    return clinvar_data, timedelta(seconds=time.time() - start_time)
-
-def write_clinvar_files(clinvar_data, variant_file, case_data_file):
-    start_time = time.time()
-
-    linking_id = 0
-    case_count = 0
-    max_methods = 0
-
-    aggregate_data = []
-    case_data = []
-
-    for clinvar_data_key, clinvar_data_values in clinvar_data.items():
-        linking_id += 1
-        gene_symbols             = set()
-        reference_sequence       = clinvar_data_key[0]
-        hgvs                     = clinvar_data_key[1]
-        cis_or_trans             = clinvar_data_key[2]
-        variation_identifiers    = set()
-        location                 = clinvar_data_key[3]
-        alternate_designations   = set()
-        official_allele_name     = ''
-        url                      = ''
-        if clinvar_data_key[4]:
-            omim_ids             = clinvar_data_key[4].replace('|', ';')
-        else:
-            omim_ids             = ''
-        condition_category       = clinvar_data_key[5]
-        clinical_significance    = clinvar_data_key[6]
-        date_last_evaluated      = date.min
-        mode_of_inheritance      = set()
-        collection_method        = clinvar_data_key[7]
-        allele_origin            = clinvar_data_key[8]
-        clinical_features        = set()
-        tissue                   = clinvar_data_key[9]
-        if clinvar_data_key[10] == 'case':
-            affected_status      = 'yes'
-        elif clinvar_data_key[10] == 'control':
-            affected_status      = 'no'
-        else:
-            affected_status      = 'unknown'
-        individuals_with_variant = 0
-        chromosomes_with_variant = 0
-        mosaicism                = 0
-        homozygotes              = 0
-        single_heterozygotes     = 0
-        compound_heterozygotes   = 0
-        hemizygotes              = 0
-        methods                  = set()
-
-        for patient_obj, clinvar_variant_obj in clinvar_data_values:
-            patient_external_id = ''
-            patient_clinical_features = []
-            patient_sex = ''
-            patient_cosanguinity = ''
-            patient_condition_comment = ''
-            patient_is_proband = ''
-            patient_kindred_id = ''
-            patient_mosaicism = ''
-            patient_zygosity = ''
-            variant_method = ('', '')
-
-            if patient_obj.get('external_id'):
-                patient_external_id = patient_obj['external_id']
-            if clinvar_variant_obj.get('gene_symbol'):
-                gene_symbols |= set(clinvar_variant_obj['gene_symbol'].split(';'))
-            if clinvar_variant_obj.get('variation_identifiers'):
-                variation_identifiers |= set(clinvar_variant_obj['variation_identifiers'].split(';'))
-            if clinvar_variant_obj.get('alternate_designations'):
-                alternate_designations |= set(clinvar_variant_obj['alternate_designations'].split('|'))
-            if clinvar_variant_obj.get('official_allele_name') and not official_allele_name:
-                official_allele_name = clinvar_variant_obj['official_allele_name']
-            if clinvar_variant_obj.get('url') and not url:
-                url = clinvar_variant_obj['url']
-            try:
-                variant_date_last_evaluated = parsedate(clinvar_variant_obj['date_last_evaluated']).date()
-                if variant_date_last_evaluated > date_last_evaluated:
-                    date_last_evaluated = variant_date_last_evaluated
-            except Exception:
-                pass
-            if patient_obj.get('global_mode_of_inheritance'):
-                for term in patient_obj['global_mode_of_inheritance']:
-                    if term == 'HP:0003745':
-                        mode_of_inheritance |= 'Sporadic'
-                    elif term == 'HP:0000006':
-                        mode_of_inheritance |= 'Autosomal dominant inheritance'
-                    elif term == 'HP:0001470':
-                        mode_of_inheritance |= 'Sex-limited autosomal dominant'
-                    elif term == 'HP:0001475':
-                        mode_of_inheritance |= 'Male-limited autosomal dominant'
-                    elif term == 'HP:0001444':
-                        mode_of_inheritance |= 'Autosomal dominant somatic cell mutation'
-                    elif term == 'HP:0001452':
-                        mode_of_inheritance |= 'Autosomal dominant contiguous gene syndrome'
-                    elif term == 'HP:0000007':
-                        mode_of_inheritance |= 'Autosomal recessive inheritance'
-                    elif term == 'HP:0010985':
-                        mode_of_inheritance |= 'Gonosomal inheritance'
-                    elif term == 'HP:0001417':
-                        mode_of_inheritance |= 'X-linked inheritance'
-                    elif term == 'HP:0001423':
-                        mode_of_inheritance |= 'X-linked dominant inheritance'
-                    elif term == 'HP:0001419':
-                        mode_of_inheritance |= 'X-linked recessive inheritance'
-                    elif term == 'HP:0001450':
-                        mode_of_inheritance |= 'Y-linked inheritance'
-                    elif term == 'HP:0001426':
-                        mode_of_inheritance |= 'Multifactorial inheritance'
-                    elif term == 'HP:0010984':
-                        mode_of_inheritance |= 'Digenic inheritance'
-                    elif term == 'HP:0010983':
-                        mode_of_inheritance |= 'Oligogenic inheritance'
-                    elif term == 'HP:0010982':
-                        mode_of_inheritance |= 'Polygenic inheritance'
-                    elif term == 'HP:0001427':
-                        mode_of_inheritance |= 'Mitochondrial inheritance'
-            if patient_obj.get('phenotype'):
-                patient_clinical_features = set(patient_obj['phenotype'].split('|'))
-                clinical_features |= patient_clinical_features
-            if patient_obj.get('gender'):
-                patient_sex = patient_obj['gender']
-            if clinvar_variant_obj.get('mosaicism') == 'yes':
-                mosaicism += 1
-                patient_mosaicism = 'yes'
-            elif clinvar_variant_obj.get('mosaicism') == 'no':
-                patient_mosaicism = 'no'
-            patient_zygosity = clinvar_variant_obj.get('zygosity')
-            if patient_zygosity == 'single heterozygote':
-                individuals_with_variant += 1
-                chromosomes_with_variant += 1
-                single_heterozygotes += 1
-            elif patient_zygosity == 'compound heterozygote':
-                individuals_with_variant += 1
-                chromosomes_with_variant += 1
-                compound_heterozygotes += 1
-            elif patient_zygosity == 'homozygote':
-                individuals_with_variant += 1
-                chromosomes_with_variant += 2
-                homozygotes += 1
-            elif patient_zygosity == 'hemizygote':
-                individuals_with_variant += 1
-                chromosomes_with_variant += 1
-                hemizygotes += 1
-            if patient_obj.get('consanguinity') == 0:
-                patient_consanguinity = 'no'
-            elif patient_obj.get('consanguinity') == 1:
-                patient_cosanguinity = 'yes'
-            if patient_obj.get('diagnosis_notes'):
-                patient_condition_comment = patient_obj['diagnosis_notes']
-            if patient_obj.get('subject_data_relationship'):
-                if patient_obj['subject_data_relationship'].lower() == 'proband':
-                    patient_is_proband = 'yes'
-                else:
-                    patient_is_proband = 'no'
-            if patient_obj.get('kindred_id'):
-                patient_kindred_id = patient_obj['kindred_id']
-            if clinvar_variant_obj.get('test_name_or_type') or clinvar_variant_obj.get('platform_type'):
-                variant_method = (clinvar_variant_obj.get('test_name_or_type', ''), clinvar_variant_obj.get('platform_type', ''))
-                methods.add(variant_method)
-
-            case_data.append([
-                linking_id,
-                patient_external_id,
-                collection_method,
-                allele_origin,
-                affected_status,
-                '',
-                ';'.join(sorted(patient_clinical_features)),
-                tissue,
-                patient_sex,
-                '',
-                '',
-                '',
-                '',
-                patient_cosanguinity,
-                patient_condition_comment,
-                '',
-                patient_is_proband,
-                patient_kindred_id,
-                '',
-                '',
-                patient_mosaicism,
-                patient_zygosity,
-                '',
-                '',
-                '',
-                '',
-                '',
-                '',
-                variant_method[0],
-                variant_method[1],
-            ])
-
-            case_count += 1
-
-        row = [
-            '',
-            linking_id,
-            ';'.join(sorted(gene_symbols)),
-            reference_sequence,
-            hgvs,
-            '',
-            '',
-            '',
-            '',
-            '',
-            '',
-            '',
-            '',
-            '',
-            '',
-            '',
-            '',
-            '',
-            '',
-            '',
-            '',
-            '',
-            cis_or_trans,
-            ';'.join(sorted(variation_identifiers)),
-            location,
-            '|'.join(sorted(alternate_designations)),
-            official_allele_name,
-            url,
-            '',
-            'OMIM',
-            omim_ids,
-            '',
-            condition_category,
-            '',
-            '',
-            clinical_significance,
-            date_last_evaluated.isoformat(),
-            '',
-            '',
-            ';'.join(sorted(mode_of_inheritance)),
-            '',
-            '',
-            '',
-            '',
-            '',
-            '',
-            '',
-            '',
-            collection_method,
-            allele_origin,
-            affected_status,
-            '',
-            ';'.join(sorted(clinical_features)),
-            '',
-            '',
-            '',
-            '',
-            '',
-            '',
-            '',
-            len(clinvar_data_values),
-            '',
-            '',
-            individuals_with_variant,
-            chromosomes_with_variant,
-            '',
-            '',
-            mosaicism,
-            homozygotes,
-            single_heterozygotes,
-            compound_heterozygotes,
-            hemizygotes,
-            '',
-            '',
-            '',
-            '',
-        ]
-
-        for test_name_or_type, platform_type in sorted(methods):
-            row.append(test_name_or_type)
-            row.append(platform_type)
-            row.append('')
-            row.append('')
-            row.append('')
-            row.append('')
-            row.append('')
-            row.append('')
-            row.append('')
-            row.append('')
-
-        aggregate_data.append(row);
-
-        if len(methods) > max_methods:
-            max_methods = len(methods)
-
-    aggregate_columns = [
-        '##Local ID',
-        'Linking ID',
-        'Gene symbol',
-        'Reference sequence',
-        'HGVS',
-        'Chromosome',
-        'Start',
-        'Stop',
-        'Reference allele',
-        'Alternate allele',
-        'Variant type',
-        'Outer start',
-        'Inner start',
-        'Inner stop',
-        'Outer stop',
-        'Variant length',
-        'Copy number',
-        'Reference copy number',
-        'Breakpoint 1',
-        'Breakpoint 2',
-        'Trace or probe data',
-        '',
-        'Cis or trans',
-        'Variation identifiers',
-        'Location',
-        'Alternate designations',
-        'Official allele name',
-        'URL',
-        '',
-        'Condition ID type',
-        'Condition ID value',
-        'Preferred condition name',
-        'Condition category',
-        'Condition uncertainty',
-        'Condition comment',
-        'Clinical significance',
-        'Date last evaluated',
-        'Assertion method',
-        'Assertion method citation',
-        'Mode of inheritance',
-        'Clinical significance citations',
-        'Citations or URLs for clinical significance without database identifiers',
-        'Comment on clinical significance',
-        'Explanation if clinical significance is other or drug response',
-        'Drug response condition',
-        'Functional consequence',
-        'Comment on functional consequence',
-        '',
-        'Collection method',
-        'Allele origin',
-        'Affected status',
-        'Structural variant method/analysis type',
-        'Clinical features',
-        'Tissue',
-        'Sex',
-        'Age range',
-        'Population Group/Ethnicity',
-        'Geographic origin',
-        'Family history',
-        'Indication',
-        'Total number of individuals tested',
-        'Number of families tested',
-        '',
-        'Number of individuals with variant',
-        'Number of chromosomes with variant',
-        'Number of families with variant',
-        'Number of families with segregation observed',
-        'Mosaicism',
-        'Number of homozygotes',
-        'Number of single heterozygotes',
-        'Number of compound heterozygotes',
-        'Number of hemizygotes',
-        'Evidence citations',
-        'Citations or URLs that cannot be represented in evidence citations column',
-        'Comment on evidence',
-        '',
-        'Test name or type',
-        'Platform type',
-        'Platform name',
-        'Method',
-        'Method purpose',
-        'Method citations',
-        'Software name and version',
-        'Software purpose',
-        'Testing laboratory',
-        'Date variant was reported to submitter',
-        '',
-        'Comment',
-        'Private comment',
-        'ClinVarAccession',
-        'Novel or Update',
-        'Replaces ClinVarAccessions',
-    ]
-
-    for i in range(1, max_methods):
-        aggregate_columns.insert(76, 'Test name or type')
-        aggregate_columns.insert(77, 'Platform type')
-        aggregate_columns.insert(78, 'Platform name')
-        aggregate_columns.insert(79, 'Method')
-        aggregate_columns.insert(80, 'Method purpose')
-        aggregate_columns.insert(81, 'Method citations')
-        aggregate_columns.insert(82, 'Software name and version')
-        aggregate_columns.insert(83, 'Software purpose')
-        aggregate_columns.insert(84, 'Testing laboratory')
-        aggregate_columns.insert(85, 'Date variant was reported to submitter')
-
-    aggregate_data.insert(0, aggregate_columns)
-
-    case_data.insert(0, [
-        '##Linking ID',
-        'Individual ID',
-        'Collection method',
-        'Allele origin',
-        'Affected status',
-        'Structural variant method/analysis type',
-        'Clinical features',
-        'Tissue',
-        'Sex',
-        'Age',
-        'Population Group/Ethnicity',
-        'Geographic origin',
-        'Indication',
-        'Family history',
-        'Condition comment',
-        '',
-        'Proband',
-        'Family ID',
-        'Segregation observed',
-        'Secondary finding',
-        'Mosaicism',
-        'Zygosity',
-        'Co-occurrences, same gene',
-        'Co-occurrences, other genes',
-        'Evidence citations',
-        'Citations or URLs that cannot be represented in evidence citations column',
-        'Comment on evidence',
-        '',
-        'Test name or type',
-        'Platform type',
-        'Platform name',
-        'Method',
-        'Method purpose',
-        'Method citations',
-        'Software name and version',
-        'Software purpose',
-    ])
-
-    csv.writer(variant_file).writerows(aggregate_data)
-    csv.writer(case_data_file).writerows(case_data)
-
-    return linking_id, case_count, timedelta(seconds=time.time() - start_time)
-
 if __name__ == '__main__':
 
     #parse arguments
@@ -529,8 +42,11 @@ if __name__ == '__main__':
     study = None
     owner = None
     gene = None
+    since = None
+    state_path = None
+    deleted_path = None
 
-    optlist, args = getopt(sys.argv[1:], '', ['base-url=', 'username=', 'password=', 'study=', 'owner=', 'gene='])
+    optlist, args = getopt(sys.argv[1:], '', ['base-url=', 'username=', 'password=', 'study=', 'owner=', 'gene=', 'since=', 'deleted='])
     for name, value in optlist:
         if name == '--base-url':
             base_url = value
@@ -544,6 +60,10 @@ if __name__ == '__main__':
             study = value.lower()
         elif name == '--owner':
             owner = value.lower()
+        elif name == '--since':
+            since, state_path = parse_since(value)
+        elif name == '--deleted':
+            deleted_path = value
 
     #get any missing arguments and initialize the bot
 
@@ -569,7 +89,7 @@ if __name__ == '__main__':
 
     bot = PhenoTipsBot(base_url, username, password)
 
-    if study == None and len(bot.list_studies()):
+    if study == None and len(bot.list_directory()['studies']):
         study = input('Are you submitting on a particular study (blank for no)? ')
         if study and study[0] == 'y':
             study = input('Input the study to submit on (blank for default): ').lower()
@@ -579,8 +99,8 @@ if __name__ == '__main__':
         study = None
 
     if owner == None:
-        users = bot.list_users()
-        groups = bot.list_groups()
+        users = bot.list_directory()['users']
+        groups = bot.list_directory()['groups']
         if len(users) > 1:
             print('Available users:')
             print('* ' + '\n* '.join(users))
@@ -595,15 +115,41 @@ if __name__ == '__main__':
 
     #begin export
 
-    patient_ids = bot.list(study, owner, having_object='PhenoTips.ClinVarVariantClass')
+    #let the server skip patients without the gene, get_clinvar_data still checks the gene symbols exactly
+    where = [('PhenoTips.ClinVarVariantClass', 'gene_symbol', 'contains', gene)] if gene else None
+    patient_ids, all_patient_ids, state, export_time = begin_export(
+        lambda since: bot.list(study, owner, having_object='PhenoTips.ClinVarVariantClass', since=since, where=where),
+        since, state_path, deleted_path
+    )
 
     print('Looking through ' + str(len(patient_ids)) + ' patient records...')
 
+    patient_keys = {}
     clinvar_data, elapsed_time1 = get_clinvar_data(
         bot, patient_ids, gene,
-        lambda count: stdout.write(str(count) + '\r')
+        lambda count: stdout.write(str(count) + '\r'),
+        patient_keys=patient_keys
     )
 
+    previous_keys = {
+        patient_id: [tuple(key) for key in keys] for patient_id, keys in state.get('variant_keys', {}).items()
+    }
+    if state['since']:
+        #the changed patients only show which variants to write, their rows have to count the cases of every patient,
+        #including the variants that the changed and deleted patients had at the last export
+        clinvar_data_keys = set(clinvar_data)
+        for patient_id in set(patient_ids) | (set(previous_keys) - set(all_patient_ids)):
+            clinvar_data_keys.update(previous_keys.get(patient_id, []))
+
+        print('Counting the cases of ' + str(len(clinvar_data_keys)) + ' changed variants...')
+
+        clinvar_data, elapsed_time = recount_clinvar_data(
+            bot, clinvar_data_keys, study, owner, gene,
+            lambda count: stdout.write(str(count) + '\r'),
+            patient_keys
+        )
+        elapsed_time1 += elapsed_time
+
     print('Writing files Variant.csv and CaseData.csv...')
 
     n_variants, n_cases, elapsed_time2 = write_clinvar_files(
@@ -614,3 +160,10 @@ if __name__ == '__main__':
 
     print('Exported ' + str(n_variants) + ' variants and ' + str(n_cases) + ' cases.')
     print('Elapsed time ' + str(elapsed_time1 + elapsed_time2))
+
+    if state_path:
+        variant_keys = {
+            patient_id: patient_keys[patient_id] if patient_id in patient_keys else previous_keys.get(patient_id, [])
+            for patient_id in all_patient_ids
+        }
+        write_export_state(state_path, export_time, all_patient_ids, variant_keys=variant_keys)
@@ -19,39 +19,75 @@
 # Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301
 # USA
 
-import csv
+import gzip
+import io
 import sys
 import time
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures import as_completed
 from datetime import timedelta
 from getopt import getopt
 from getpass import getpass
 from phenotipsbot import PhenoTipsBot
+from phenotipsbot import begin_export
+from phenotipsbot import export_patients
+from phenotipsbot import parse_since
+from phenotipsbot import write_export_state
+from shutil import copyfileobj
 from sys import stderr
 from sys import stdout
-
-def export_patients(bot, patient_ids, out_file, progress_callback):
+from tempfile import TemporaryDirectory
+
+def export_shard(base_url, auth, ssl_verify, cache_dir, patient_ids, shard_path, out_format):
+    #runs in a worker process, which needs its own bot and therefore its own connections
+    bot = PhenoTipsBot(base_url, auth[0], auth[1], ssl_verify, cache_dir)
+    if out_format == 'parquet':
+        shard_file = open(shard_path, 'wb')
+    else:
+        shard_file = open(shard_path, 'w', newline='')
+    n_exported, elapsed_time = export_patients(bot, patient_ids, shard_file, lambda count: None, out_format)
+    shard_file.close()
+    return n_exported
+
+def export_patients_sharded(bot, patient_ids, shard_paths, progress_callback, out_format='csv'):
     start_time = time.time()
-    count = 0
     n_exported = 0
 
-    prop_names = bot.list_patient_class_properties()
-
-    writer = csv.writer(out_file)
-    writer.writerow(prop_names)
-
-    for patient_id in patient_ids:
-        progress_callback(count)
-        count += 1
-
-        patient = bot.get(patient_id)
-        row = []
-        for prop_name in prop_names:
-            row.append(patient[prop_name])
-        writer.writerow(row)
-        n_exported += 1
+    #give each process a contiguous range of patients so that the shards can be concatenated in order
+    n_shards = len(shard_paths)
+    shard_size = -(-len(patient_ids) // n_shards)
+    with ProcessPoolExecutor(n_shards) as executor:
+        futures = []
+        for i, shard_path in enumerate(shard_paths):
+            shard_patient_ids = patient_ids[i * shard_size:(i + 1) * shard_size]
+            futures.append(executor.submit(
+                export_shard, bot.base, bot.auth, bot.ssl_verify, bot.cache_dir, shard_patient_ids, shard_path, out_format
+            ))
+        for future in as_completed(futures):
+            n_exported += future.result()
+            progress_callback(n_exported)
 
     return n_exported, timedelta(seconds=time.time() - start_time)
 
+def merge_shards(shard_paths, out_file, out_format='csv'):
+    if out_format == 'parquet':
+        import pyarrow.parquet
+        writer = None
+        for shard_path in shard_paths:
+            shard = pyarrow.parquet.ParquetFile(shard_path)
+            if not writer:
+                writer = pyarrow.parquet.ParquetWriter(out_file, shard.schema_arrow)
+            for i in range(shard.num_row_groups):
+                writer.write_table(shard.read_row_group(i))
+        writer.close()
+    else:
+        for i, shard_path in enumerate(shard_paths):
+            with open(shard_path, 'r', newline='') as shard_file:
+                #every CSV shard has a header row, but only the first one should be kept
+                if out_format == 'csv' and i > 0:
+                    shard_file.readline()
+                copyfileobj(shard_file, out_file)
+
 if __name__ == '__main__':
 
     #parse arguments
@@ -61,8 +97,15 @@ if __name__ == '__main__':
     password = None
     study = None
     owner = None
-
-    optlist, args = getopt(sys.argv[1:], '-y', ['base-url=', 'username=', 'password=', 'study=', 'owner='])
+    since = None
+    state_path = None
+    deleted_path = None
+    out_format = 'csv'
+    compression = None
+    n_shards = 1
+    shard_prefix = None
+
+    optlist, args = getopt(sys.argv[1:], '-y', ['base-url=', 'username=', 'password=', 'study=', 'owner=', 'since=', 'deleted=', 'format=', 'compress=', 'shards=', 'shard-prefix='])
     for name, value in optlist:
         if name == '--base-url':
             base_url = value
@@ -74,6 +117,18 @@ if __name__ == '__main__':
             study = value
         elif name == '--owner':
             owner = value
+        elif name == '--since':
+            since, state_path = parse_since(value)
+        elif name == '--deleted':
+            deleted_path = value
+        elif name == '--format':
+            out_format = value
+        elif name == '--compress':
+            compression = value
+        elif name == '--shards':
+            n_shards = int(value)
+        elif name == '--shard-prefix':
+            shard_prefix = value
 
     #get any missing arguments and initialize the bot
 
@@ -100,7 +155,7 @@ if __name__ == '__main__':
     bot = PhenoTipsBot(base_url, username, password)
 
     if study == None:
-        studies = bot.list_studies()
+        studies = bot.list_directory()['studies']
         if len(studies):
             sys.stderr.write('Are you exporting from a particular study (blank for no)? ')
             study = input()
@@ -115,8 +170,8 @@ if __name__ == '__main__':
         study = None
 
     if owner == None:
-        users = bot.list_users()
-        groups = bot.list_groups()
+        users = bot.list_directory()['users']
+        groups = bot.list_directory()['groups']
         if len(users) > 1:
             print('Available users:')
             print('* ' + '\n* '.join(users))
@@ -128,13 +183,47 @@ if __name__ == '__main__':
 
     #begin export
 
-    patient_ids = bot.list(study, owner)
+    patient_ids, all_patient_ids, state, export_time = begin_export(
+        lambda since: bot.list(study, owner, since=since), since, state_path, deleted_path
+    )
 
     stderr.write('Exporting ' + str(len(patient_ids)) + ' patient records...\n')
     stderr.write('\n')
 
-    n_exported, elapsed_time = export_patients(bot, patient_ids, stdout, lambda count: stderr.write(str(count) + '\r'))
+    if n_shards > 1 and shard_prefix:
+        shard_paths = [shard_prefix + str(i) + '.' + out_format for i in range(n_shards)]
+        n_exported, elapsed_time = export_patients_sharded(bot, patient_ids, shard_paths, lambda count: stderr.write(str(count) + '\r'), out_format)
+        stderr.write('\n')
+        stderr.write('Exported ' + str(n_exported) + ' patients to ' + ', '.join(shard_paths) + '.\n')
+        stderr.write('Elapsed time ' + str(elapsed_time) + '\n')
+        if state_path:
+            write_export_state(state_path, export_time, all_patient_ids)
+        exit(0)
+
+    #Parquet files are binary and compress themselves; CSV and NDJSON can be compressed as they are written
+    if out_format == 'parquet':
+        out_file = stdout.buffer
+    elif compression == 'gzip':
+        out_file = io.TextIOWrapper(gzip.GzipFile(fileobj=stdout.buffer, mode='wb'), newline='')
+    elif compression == 'zstd':
+        import zstandard
+        out_file = io.TextIOWrapper(zstandard.ZstdCompressor().stream_writer(stdout.buffer, closefd=False), newline='')
+    else:
+        out_file = stdout
+
+    if n_shards > 1:
+        with TemporaryDirectory() as shard_dir:
+            shard_paths = [shard_dir + '/' + str(i) + '.' + out_format for i in range(n_shards)]
+            n_exported, elapsed_time = export_patients_sharded(bot, patient_ids, shard_paths, lambda count: stderr.write(str(count) + '\r'), out_format)
+            merge_shards(shard_paths, out_file, out_format)
+    else:
+        n_exported, elapsed_time = export_patients(bot, patient_ids, out_file, lambda count: stderr.write(str(count) + '\r'), out_format)
+    if out_file is not stdout and out_format != 'parquet':
+        out_file.close()
 
     stderr.write('\n')
     stderr.write('Exported ' + str(n_exported) + ' patients.\n')
     stderr.write('Elapsed time ' + str(elapsed_time) + '\n')
+
+    if state_path:
+        write_export_state(state_path, export_time, all_patient_ids)
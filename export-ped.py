@@ -26,6 +26,8 @@ from datetime import timedelta
 from getopt import getopt
 from getpass import getpass
 from phenotipsbot import PhenoTipsBot
+from phenotipsbot import fetch_patients
+from phenotipsbot import map_concurrently
 from sys import stderr
 from sys import stdout
 
@@ -75,7 +77,7 @@ if not password:
 bot = PhenoTipsBot(base_url, username, password)
 
 if study == None:
-    studies = bot.list_studies()
+    studies = bot.list_directory()['studies']
     if len(studies):
         print('Available studies:')
         print('* ' + '\n* '.join(studies))
@@ -90,8 +92,8 @@ elif study == 'None':
     study = None
 
 if owner == None:
-    users = bot.list_users()
-    groups = bot.list_groups()
+    users = bot.list_directory()['users']
+    groups = bot.list_directory()['groups']
     if len(users) > 1:
         print('Available users:')
         print('* ' + '\n* '.join(users))
@@ -111,16 +113,45 @@ patient_ids = bot.list(study, owner)
 stderr.write('Looking through ' + str(len(patient_ids)) + ' patient records...\n')
 stderr.write('\n')
 
+#download every patient and every relative relationship once, then build the pedigree in memory
+
+patients = {}
+patient_ids_by_eid = {}
+relative_objs = {}
+
+def get_relative_objs(patient_id):
+    return [bot.get_relative(patient_id, relative_num) for relative_num in bot.list_relatives(patient_id)]
+
+for patient_id, patient in fetch_patients(bot, patient_ids, compact=True):
+    stderr.write(str(count) + '\r')
+    count += 1
+    patients[patient_id] = patient
+    if patient.get('external_id'):
+        patient_ids_by_eid[patient['external_id']] = patient_id
+
+patient_ids_with_relatives = set(bot.list(study, owner, having_object='PhenoTips.RelativeClass'))
+patient_ids_with_relatives = [patient_id for patient_id in patient_ids if patient_id in patient_ids_with_relatives]
+for patient_id, objs in zip(patient_ids_with_relatives, map_concurrently(get_relative_objs, patient_ids_with_relatives)):
+    relative_objs[patient_id] = objs
+
+def get_gender(external_id):
+    #parents outside of the study or owner's patients are looked up individually, but only once each
+    if external_id not in patient_ids_by_eid:
+        patient_id = bot.get_id(external_id)
+        patient_ids_by_eid[external_id] = patient_id
+        if patient_id:
+            patients[patient_id] = bot.get(patient_id, compact=True)
+    patient_id = patient_ids_by_eid[external_id]
+    return patients[patient_id].get('gender') if patient_id else None
+
+stderr.write('          \r')
 stdout.write('#FID\tIID\tPAT\tMAT\tSEX\tPHENOTYPE\n')
 writer = csv.writer(sys.stdout, delimiter='\t')
 
 fid = study if study else '0'
 
 for patient_id in patient_ids:
-    stderr.write(str(count) + '\r')
-    count += 1
-
-    patient = bot.get(patient_id)
+    patient = patients[patient_id]
     iid = patient['external_id']
     pat = '0'
     mat = '0'
@@ -137,25 +168,23 @@ for patient_id in patient_ids:
     else:
         phenotype = 0
 
-    for relative_num in bot.list_relatives(patient_id):
-        relative_obj = bot.get_relative(patient_id, relative_num)
+    for relative_obj in relative_objs.get(patient_id, []):
         relative_eid = relative_obj['relative_of']
         if not relative_eid:
-            raise Exception('Relative ' + relative_num + ' of patient ' + patient_id + ' is malformed')
-        relative = bot.get(bot.get_id(relative_eid))
+            raise Exception('A relative of patient ' + patient_id + ' is malformed')
         if relative_obj['relative_type'] == 'child':
-            if relative['gender'] == 'M':
+            relative_gender = get_gender(relative_eid)
+            if relative_gender == 'M':
                 if pat != '0':
                     raise Exception('Patient ' + iid + ' has two fathers: ' + pat + ' and ' + relative_eid)
                 pat = relative_eid
-            elif relative['gender'] == 'F':
+            elif relative_gender == 'F':
                 if mat != '0':
                     raise Exception('Patient ' + iid + ' has two mothers: ' + mat + ' and ' + relative_eid)
                 mat = relative_eid
             else:
                 raise Exception('Parent ' + relative_eid + ' is neither male nor female')
 
-    stderr.write('          \r')
     writer.writerow([fid, iid, pat, mat, sex, phenotype])
 
 stderr.write('\n')
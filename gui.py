@@ -1,6 +1,19 @@
 #!/usr/bin/python3
 
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
 from phenotipsbot import PhenoTipsBot
+from phenotipsbot import begin_export
+from phenotipsbot import export_patients
+from phenotipsbot import get_clinvar_data
+from phenotipsbot import get_clinvar_index_path
+from phenotipsbot import get_patient_ids
+from phenotipsbot import import_patients
+from phenotipsbot import index_clinvar_variants
+from phenotipsbot import parse_csv_file
+from phenotipsbot import write_clinvar_files
+from phenotipsbot import write_export_state
 from PyQt5 import uic
 from PyQt5.QtCore import pyqtSlot
 from PyQt5.QtCore import Q_ARG
@@ -14,18 +27,14 @@ from requests import ConnectionError
 from requests import HTTPError
 from sys import argv
 from sys import exit
-from threading import Thread
-parse_csv_file = __import__('import-csv').parse_csv_file
-get_patient_ids = __import__('import-csv').get_patient_ids
-import_patients = __import__('import-csv').import_patients
-export_patients = __import__('export-csv').export_patients
-get_clinvar_data = __import__('export-clinvar').get_clinvar_data
-write_clinvar_files = __import__('export-clinvar').write_clinvar_files
+from threading import Event
 
 IMPORT_CSV = 1
 EXPORT_CSV = 2
 EXPORT_CLINVAR = 3
 
+PROGRESS_INTERVAL = 0.05 #seconds, so that the progress bar is redrawn at most 20 times per second
+
 class MainWindow(QMainWindow):
     def __init__(self):
         super(MainWindow, self).__init__()
@@ -41,6 +50,19 @@ class MainWindow(QMainWindow):
         self.exportCsvOption.clicked.connect(self.operationOption_clicked)
         self.exportClinVarOption.clicked.connect(self.operationOption_clicked)
         self.browseButton.clicked.connect(self.browseButton_clicked)
+        self.refreshButton.clicked.connect(self.refreshButton_clicked)
+        self.cancelButton.clicked.connect(self.cancelButton_clicked)
+        self.cancelButton.setVisible(False)
+        #one job at a time runs in the background so that the window stays responsive
+        self.jobs = ThreadPoolExecutor(1)
+        self.cancelEvent = Event()
+        self.status = ''
+        self.maxProgress = 0
+        self.progressStartTime = 0
+        self.lastProgressTime = 0
+        self.navigationEnabled = (False, True)
+        #connections and lists of studies, users, groups, and genes for each site and login
+        self.sessions = {}
 
     def asyncAddGeneSelectorItem(self, item):
         QMetaObject.invokeMethod(self, 'addGeneSelectorItem', Qt.QueuedConnection, Q_ARG(str, item))
@@ -62,7 +84,7 @@ class MainWindow(QMainWindow):
         QMetaObject.invokeMethod(self.geneSelector, 'setVisible', Qt.QueuedConnection, Q_ARG(bool, False))
 
     def asyncLockUi(self, status, maxProgress = 0):
-        QMetaObject.invokeMethod(self, 'setEnabled', Qt.QueuedConnection, Q_ARG(bool, False))
+        QMetaObject.invokeMethod(self, 'lockUi', Qt.QueuedConnection)
         self.asyncSetStatus(status, maxProgress)
         QMetaObject.invokeMethod(self.progressBar, 'setVisible', Qt.QueuedConnection, Q_ARG(bool, True))
 
@@ -88,9 +110,25 @@ class MainWindow(QMainWindow):
         QMetaObject.invokeMethod(self.stackedWidget, 'setCurrentIndex', Qt.QueuedConnection, Q_ARG(int, index))
 
     def asyncSetProgress(self, progress):
+        now = time.time()
+        if now - self.lastProgressTime < PROGRESS_INTERVAL and progress < self.maxProgress:
+            return
+        self.lastProgressTime = now
         QMetaObject.invokeMethod(self.progressBar, 'setValue', Qt.QueuedConnection, Q_ARG(int, progress))
+        if self.maxProgress and progress and now > self.progressStartTime:
+            rate = progress / (now - self.progressStartTime)
+            remaining = timedelta(seconds=round((self.maxProgress - progress) / rate))
+            status = (
+                self.status + ' ' + str(progress) + ' of ' + str(self.maxProgress) + ', ' +
+                str(round(rate, 1)) + ' per second, about ' + str(remaining) + ' left'
+            )
+            QMetaObject.invokeMethod(self.statusLabel, 'setText', Qt.QueuedConnection, Q_ARG(str, status))
 
     def asyncSetStatus(self, status, maxProgress = 0):
+        self.status = status
+        self.maxProgress = maxProgress
+        self.progressStartTime = time.time()
+        self.lastProgressTime = 0
         QMetaObject.invokeMethod(self.statusLabel, 'setText', Qt.QueuedConnection, Q_ARG(str, status))
         QMetaObject.invokeMethod(self.statusLabel, 'setVisible', Qt.QueuedConnection, Q_ARG(bool, bool(status)))
         QMetaObject.invokeMethod(self.progressBar, 'setMaximum', Qt.QueuedConnection, Q_ARG(int, maxProgress))
@@ -102,35 +140,71 @@ class MainWindow(QMainWindow):
         QMetaObject.invokeMethod(self.summaryLabel, 'setText', Qt.QueuedConnection, Q_ARG(str, summary))
 
     def asyncUnlockUi(self, status = ''):
-        QMetaObject.invokeMethod(self, 'setEnabled', Qt.QueuedConnection, Q_ARG(bool, True))
+        QMetaObject.invokeMethod(self, 'unlockUi', Qt.QueuedConnection)
         QMetaObject.invokeMethod(self.progressBar, 'setVisible', Qt.QueuedConnection, Q_ARG(bool, False))
         self.asyncSetStatus(status)
 
-    def turnToPage2(self):
+    def startJob(self, job):
+        self.cancelEvent = Event()
+        self.jobs.submit(job)
+
+    def turnToPage2(self, refresh = False):
         self.asyncLockUi('Finding studies, users, and work groups...')
         self.site = self.siteSelector.currentText().rstrip('/')
         self.username = self.usernameTextbox.text()
         self.password = self.passwordTextbox.text()
-        self.bot = PhenoTipsBot(self.site, self.username, self.password)
         try:
-            self.studies = self.bot.list_studies()
-            self.users = self.bot.list_users()
-            self.groups = self.bot.list_groups()
+            #going back and choosing another operation on the same site reuses everything that was already downloaded
+            session = self.sessions.get((self.site, self.username, self.password))
+            if not session or refresh:
+                bot = PhenoTipsBot(self.site, self.username, self.password)
+                directory = bot.list_directory()
+                session = {
+                    'bot': bot,
+                    'studies': directory['studies'],
+                    'users': directory['users'],
+                    'groups': directory['groups'],
+                    'gene_table': None,
+                    'patient_ids': None,
+                    'variants': None,
+                }
+                self.sessions[(self.site, self.username, self.password)] = session
+            self.bot = session['bot']
+            self.studies = session['studies']
+            self.users = session['users']
+            self.groups = session['groups']
             self.gene_table = {}
+            self.clinvar_patient_ids = []
+            self.variants = {}
             if self.operation == EXPORT_CLINVAR:
-                self.asyncSetStatus('Getting patient list...')
-                patient_ids = self.bot.list(having_object='PhenoTips.ClinVarVariantClass')
-                self.asyncSetStatus('Getting gene list...', len(patient_ids))
-                count = 0
-                for patient_id in patient_ids:
-                    for variant_num in self.bot.list_objects(patient_id, 'PhenoTips.ClinVarVariantClass'):
-                        gene = self.bot.get_object(patient_id, 'PhenoTips.ClinVarVariantClass', variant_num).get('gene_symbol').upper()
-                        if gene:
-                            if gene not in self.gene_table:
-                                self.gene_table[gene] = set()
-                            self.gene_table[gene].add(patient_id)
-                    count += 1
-                    self.asyncSetProgress(count)
+                if session['gene_table'] == None:
+                    self.asyncSetStatus('Getting patient list...')
+                    #the genes of each patient are saved between runs, so only the patients changed since the last run
+                    #have to be downloaded again
+                    index_path = get_clinvar_index_path(self.bot)
+                    changed_patient_ids, patient_ids, index, index_time = begin_export(
+                        lambda since: self.bot.list(having_object='PhenoTips.ClinVarVariantClass', since=since),
+                        state_path=index_path
+                    )
+                    genes = index.get('genes', {})
+                    patient_genes = {patient_id: genes[patient_id] for patient_id in patient_ids if patient_id in genes}
+                    self.asyncSetStatus('Getting gene list...', len(changed_patient_ids))
+                    #keep the downloaded variants so that the export doesn't have to download them again
+                    gene_table, variants = index_clinvar_variants(self.bot, changed_patient_ids, self.asyncSetProgress, cancel_event=self.cancelEvent, patient_genes=patient_genes)
+                    if self.cancelEvent.is_set():
+                        self.asyncUnlockUi('Cancelled')
+                        return
+                    if index_path:
+                        try:
+                            write_export_state(index_path, index_time, patient_ids, genes=patient_genes)
+                        except OSError:
+                            pass
+                    session['gene_table'] = gene_table
+                    session['patient_ids'] = list(patient_genes)
+                    session['variants'] = variants
+                self.gene_table = session['gene_table']
+                self.clinvar_patient_ids = session['patient_ids']
+                self.variants = session['variants']
         except ConnectionError:
             self.asyncUnlockUi('The site appears to be mistyped')
             return
@@ -231,7 +305,10 @@ class MainWindow(QMainWindow):
             )
 
             self.asyncSetStatus('Checking ' + str(len(self.patients)) + ' external IDs...', len(self.patients))
-            self.patient_ids = get_patient_ids(self.bot, self.patients, self.asyncSetProgress)
+            self.patient_ids = get_patient_ids(self.bot, self.patients, self.asyncSetProgress, cancel_event=self.cancelEvent)
+            if self.cancelEvent.is_set():
+                self.asyncUnlockUi('Cancelled')
+                return
             self.n_to_import = str(len(self.patients) - len(self.patient_ids))
             self.n_to_update = str(len(self.patient_ids))
         except Exception as err:
@@ -248,13 +325,18 @@ class MainWindow(QMainWindow):
             self.asyncLockUi('Importing/updating...', len(self.patients))
 
             try:
-                elapsedTime = import_patients(self.bot, self.patients, self.patient_ids, self.study, self.owner, self.asyncSetProgress)
+                n_created, n_changed, n_unchanged, elapsedTime = import_patients(self.bot, self.patients, self.patient_ids, self.study, self.owner, self.asyncSetProgress, cancel_event=self.cancelEvent)
             except Exception as err:
                 self.asyncUnlockUi(str(err))
                 return
+            finally:
+                #the imported patients may have new or changed variants
+                self.sessions[(self.site, self.username, self.password)]['gene_table'] = None
 
             self.asyncSetSummary(
-                'Imported ' + self.n_to_import + ' patients and updated ' + self.n_to_update + ' patients.\n' +
+                ('Cancelled. ' if self.cancelEvent.is_set() else '') +
+                'Imported ' + str(n_created) + ' patients and updated ' + str(n_changed) + ' patients. ' +
+                str(n_unchanged) + ' patients were already up to date.\n' +
                 'Elapsed time ' + str(elapsedTime)
             )
         elif self.operation == EXPORT_CSV:
@@ -264,13 +346,14 @@ class MainWindow(QMainWindow):
                 patient_ids = self.bot.list(self.study, self.owner)
                 self.asyncSetStatus('Exporting...', len(patient_ids))
                 outFile = open(self.path, 'w')
-                n_exported, elapsedTime = export_patients(self.bot, patient_ids, outFile, self.asyncSetProgress)
+                n_exported, elapsedTime = export_patients(self.bot, patient_ids, outFile, self.asyncSetProgress, cancel_event=self.cancelEvent)
                 outFile.close()
             except Exception as err:
                 self.asyncUnlockUi(str(err))
                 return
 
             self.asyncSetSummary(
+                ('Cancelled. ' if self.cancelEvent.is_set() else '') +
                 'Exported ' + str(n_exported) + ' patients.\n' +
                 'Elapsed time ' + str(elapsedTime))
         else:
@@ -281,12 +364,18 @@ class MainWindow(QMainWindow):
                     if self.gene:
                         patient_ids = self.gene_table[self.gene]
                     else:
-                        patient_ids = set.intersection(*self.gene_table.values())
+                        #every indexed patient, including the ones whose variants have no gene symbol
+                        patient_ids = self.clinvar_patient_ids
                 else:
-                    patient_ids = self.bot.list(self.study, self.owner, having_object='PhenoTips.ClinVarVariantClass')
+                    where = [('PhenoTips.ClinVarVariantClass', 'gene_symbol', 'contains', self.gene)] if self.gene else None
+                    patient_ids = self.bot.list(self.study, self.owner, having_object='PhenoTips.ClinVarVariantClass', where=where)
 
                 self.asyncLockUi('Exporting...', len(patient_ids))
-                clinvar_data, elapsedTime1 = get_clinvar_data(self.bot, patient_ids, self.gene, self.asyncSetProgress)
+                clinvar_data, elapsedTime1 = get_clinvar_data(self.bot, patient_ids, self.gene, self.asyncSetProgress, self.cancelEvent, self.variants)
+                if self.cancelEvent.is_set():
+                    #a partial ClinVar submission would be misleading, so don't write anything
+                    self.asyncUnlockUi('Cancelled')
+                    return
 
                 self.asyncSetStatus('Writing files Variant.csv and CaseData.csv...')
                 variantsFile = open(self.path + '/Variant.csv', 'w')
@@ -319,6 +408,24 @@ class MainWindow(QMainWindow):
     def addOwnerSelectorItem(self, item):
         self.ownerSelector.addItem(item)
 
+    @pyqtSlot()
+    def lockUi(self):
+        #disable everything except the cancel button
+        if self.stackedWidget.isEnabled():
+            self.navigationEnabled = (self.previousButton.isEnabled(), self.nextButton.isEnabled())
+        self.stackedWidget.setEnabled(False)
+        self.previousButton.setEnabled(False)
+        self.nextButton.setEnabled(False)
+        self.cancelButton.setEnabled(True)
+        self.cancelButton.setVisible(True)
+
+    @pyqtSlot()
+    def unlockUi(self):
+        self.stackedWidget.setEnabled(True)
+        self.previousButton.setEnabled(self.navigationEnabled[0])
+        self.nextButton.setEnabled(self.navigationEnabled[1])
+        self.cancelButton.setVisible(False)
+
     def browseButton_clicked(self):
         dialog = QFileDialog()
         if self.operation == IMPORT_CSV:
@@ -339,6 +446,19 @@ class MainWindow(QMainWindow):
         if dialog.exec():
             self.pathLabel.setText(QDir.toNativeSeparators(dialog.selectedFiles()[0]))
 
+    def refreshButton_clicked(self):
+        self.startJob(lambda: self.turnToPage2(True))
+
+    def closeEvent(self, event):
+        #let a running job stop instead of keeping the program alive after the window is closed
+        self.cancelEvent.set()
+        super(MainWindow, self).closeEvent(event)
+
+    def cancelButton_clicked(self):
+        self.cancelEvent.set()
+        self.cancelButton.setEnabled(False)
+        self.statusLabel.setText('Cancelling...')
+
     def nextButton_clicked(self):
         if self.stackedWidget.currentIndex() == 0: #operation
             self.importMode = self.importCsvOption.isChecked()
@@ -351,7 +471,7 @@ class MainWindow(QMainWindow):
             self.previousButton.setEnabled(True)
             self.stackedWidget.setCurrentIndex(1) #login
         elif self.stackedWidget.currentIndex() == 1: #login
-            Thread(target=self.turnToPage2).start() #study
+            self.startJob(self.turnToPage2) #study
         elif self.stackedWidget.currentIndex() == 2: #study, owner, and gene
             self.study = self.studySelector.currentText()
             if self.study == 'All studies':
@@ -368,18 +488,18 @@ class MainWindow(QMainWindow):
             if self.gene == 'All genes':
                 self.gene = None
             self.pathLabel.setText('')
-            Thread(target=self.turnToPage3).start() #file
+            self.startJob(self.turnToPage3) #file
         elif self.stackedWidget.currentIndex() == 3: #file
             self.path = self.pathLabel.text()
             if self.path:
                 if self.operation == IMPORT_CSV:
-                    Thread(target=self.turnToPage4).start() #confirmation
+                    self.startJob(self.turnToPage4) #confirmation
                 else:
-                    Thread(target=self.turnToPage5).start() #summary
+                    self.startJob(self.turnToPage5) #summary
             else:
                 self.browseButton_clicked()
         elif self.stackedWidget.currentIndex() == 4: #confirmation
-            Thread(target=self.turnToPage5).start() #summary
+            self.startJob(self.turnToPage5) #summary
         elif self.stackedWidget.currentIndex() == 5: #summary
             self.previousButton.setEnabled(False)
             self.stackedWidget.setCurrentIndex(0) #operation
@@ -19,118 +19,16 @@
 # Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301
 # USA
 
-import csv
-import re
 import sys
-import time
-from datetime import timedelta
-from dateutil.parser import parse as parsedate
 from getopt import getopt
 from getpass import getpass
 from phenotipsbot import PhenoTipsBot
+from phenotipsbot import get_patient_ids
+from phenotipsbot import import_patients
+from phenotipsbot import iter_csv_file
+from phenotipsbot import parse_csv_file
+from phenotipsbot import stream_import_patients
 from sys import stdout
-from traceback import print_exc
-
-def normalize(field_name, field_value, field_metadata):
-    field_value = field_value.strip()
-    field_type = field_metadata['type']
-    try:
-        if field_type == 'Date':
-            return parsedate(field_value).strftime('%Y-%m-%d')
-        elif field_type == 'Boolean':
-            field_value = field_value.lower()
-            if field_value in ('t', 'true', 'y', 'yes', '1'):
-                return '1'
-            elif field_value in ('f', 'false', 'n', 'no', '0'):
-                return '0'
-            else:
-                return None
-        elif field_type == 'Number':
-            if field_metadata['numberType'] in ('integer', 'long'):
-                return int(field_value)
-            else:
-                return float(field_value)
-        elif field_type == 'StaticList':
-            possible_values = field_metadata['values']
-            if not possible_values:
-                return field_value
-            field_value = field_value.lower()
-            for key, value in possible_values.items():
-                if field_value == key.lower() or field_value == value.lower():
-                    return key
-            return None
-        else:
-            validationRegex = field_metadata['validationRegExp']
-            if validationRegex and not re.fullmatch(validationRegex, field_value):
-                return None
-            return field_value
-    except ValueError:
-        return None
-
-def parse_csv_file(bot, file_name, unrecognized_column_callback, unrecognized_value_callback,
-                   identifier_column_callback):
-    possible_fields = bot.list_patient_class_properties()
-
-    reader = csv.DictReader(open(file_name, 'r'))
-    patients = []
-
-    #warn about unrecognized fields
-    for field in reader.fieldnames:
-        if field == 'identifier':
-            identifier_column_callback()
-        if field not in possible_fields:
-            unrecognized_column_callback(field)
-
-    for row in reader:
-        #skip empty rows
-        if len(row) == 0:
-            continue
-
-        patient = {}
-
-        for field in reader.fieldnames:
-            if field == 'identifier':
-                continue
-            value = row[field]
-            if value == '':
-                continue
-            patient[field] = normalize(field, value, possible_fields[field])
-            if patient[field] == None:
-                del patient[field]
-                unrecognized_value_callback(value, field)
-
-        patients.append(patient)
-
-    return patients
-
-def get_patient_ids(bot, patients, progress_callback):
-    patient_ids = {}
-    count = 0
-
-    for patient in patients:
-        external_id = patient.get('external_id')
-        if external_id:
-            patient_id = bot.get_id(external_id)
-            if patient_id:
-                patient_ids[external_id] = patient_id
-            count += 1
-            progress_callback(count)
-
-    return patient_ids
-
-def import_patients(bot, patients, patient_ids, study, owner, progress_callback):
-    count = 0
-    start_time = time.time()
-
-    for patient in patients:
-        if patient_ids.get(patient.get('external_id')):
-            bot.set(patient_ids[patient['external_id']], patient)
-        else:
-            bot.create(patient, study, owner)
-        count += 1
-        progress_callback(count)
-
-    return timedelta(seconds=time.time() - start_time)
 
 if __name__ == '__main__':
 
@@ -145,9 +43,10 @@ if __name__ == '__main__':
     password = None
     study = None
     owner = None
+    stream = False
     yes = False
 
-    optlist, args = getopt(sys.argv[1:], '-y', ['base-url=', 'username=', 'password=', 'study=', 'owner=', 'yes'])
+    optlist, args = getopt(sys.argv[1:], '-y', ['base-url=', 'username=', 'password=', 'study=', 'owner=', 'stream', 'yes'])
     for name, value in optlist:
         if name == '--base-url':
             base_url = value
@@ -159,6 +58,8 @@ if __name__ == '__main__':
             study = value
         elif name == '--owner':
             owner = value
+        elif name == '--stream':
+            stream = True
         elif name in ('-y', '--yes'):
             yes = True
 
@@ -184,9 +85,9 @@ if __name__ == '__main__':
 
     bot = PhenoTipsBot(base_url, username, password)
 
-    #parse CSV file
+    #parse CSV file (lazily if streaming)
 
-    patients = parse_csv_file(
+    patients = (iter_csv_file if stream else parse_csv_file)(
         bot,
         args[0],
         lambda column: print('WARNING: Ignoring unrecognized column "' + column + '"'),
@@ -197,7 +98,7 @@ if __name__ == '__main__':
     #get the rest of the missing arguments
 
     if study == None:
-        studies = bot.list_studies()
+        studies = bot.list_directory()['studies']
         if len(studies):
             print('Available study forms:')
             print('* ' + '\n* '.join(studies))
@@ -206,8 +107,8 @@ if __name__ == '__main__':
         study = None
 
     if owner == None:
-        users = bot.list_users()
-        groups = bot.list_groups()
+        users = bot.list_directory()['users']
+        groups = bot.list_directory()['groups']
         if len(users) > 1:
             print('Available users:')
             print('* ' + '\n* '.join(users))
@@ -219,6 +120,13 @@ if __name__ == '__main__':
     if not owner:
         owner = username
 
+    if stream:
+        if yes or input('You are about to import or update every patient in ' + args[0] + '. Type y to continue: ')[0] == 'y':
+            n_created, n_changed, n_unchanged, elapsed_time = stream_import_patients(bot, patients, study, owner, lambda count: stdout.write(str(count) + '\r'))
+            print('Imported ' + str(n_created) + ' new patients, updated ' + str(n_changed) + ' existing patients, and left ' + str(n_unchanged) + ' unchanged patients alone.')
+            print('All done! Elapsed time ' + str(elapsed_time))
+        exit(0)
+
     #check external IDs
 
     print('Checking ' + str(len(patients)) + ' external IDs...')
@@ -231,5 +139,6 @@ if __name__ == '__main__':
     n_to_update = str(len(patient_ids))
 
     if yes or input('You are about to import ' + n_to_import + ' new patients and update ' + n_to_update + ' existing patients. Type y to continue: ')[0] == 'y':
-        elapsed_time = import_patients(bot, patients, patient_ids, study, owner, lambda count: stdout.write(str(count) + '\r'))
+        n_created, n_changed, n_unchanged, elapsed_time = import_patients(bot, patients, patient_ids, study, owner, lambda count: stdout.write(str(count) + '\r'))
+        print('Imported ' + str(n_created) + ' new patients, updated ' + str(n_changed) + ' existing patients, and left ' + str(n_unchanged) + ' unchanged patients alone.')
         print('All done! Elapsed time ' + str(elapsed_time))
@@ -26,6 +26,7 @@ from datetime import timedelta
 from getopt import getopt
 from getpass import getpass
 from phenotipsbot import PhenoTipsBot
+from phenotipsbot import map_concurrently
 from requests.exceptions import HTTPError
 from sys import stdout
 
@@ -38,9 +39,10 @@ if len(sys.argv) < 2:
 base_url = None
 username = None
 password = None
+dry_run = False
 yes = False
 
-optlist, args = getopt(sys.argv[1:], '-y', ['base-url=', 'username=', 'password=', 'yes'])
+optlist, args = getopt(sys.argv[1:], '-y', ['base-url=', 'username=', 'password=', 'dry-run', 'yes'])
 for name, value in optlist:
     if name == '--base-url':
         base_url = value
@@ -48,6 +50,8 @@ for name, value in optlist:
         username = value
     elif name == '--password':
         password = value
+    elif name == '--dry-run':
+        dry_run = True
     elif name in ('-y', '--yes'):
         yes = True
 
@@ -78,13 +82,17 @@ bot = PhenoTipsBot(base_url, username, password)
 #parse PED file
 #http://pngu.mgh.harvard.edu/~purcell/plink/data.shtml#ped
 
+patient_ids = {}
+
 def get_id(external_id):
     if external_id == '0':
         return None
-    try:
-        return bot.get_id(external_id)
-    except HTTPError:
-        return None
+    if external_id not in patient_ids:
+        try:
+            patient_ids[external_id] = bot.get_id(external_id)
+        except HTTPError:
+            patient_ids[external_id] = None
+    return patient_ids[external_id]
 
 print('Matching pedigree rows to the patient database...')
 count = 0
@@ -147,13 +155,63 @@ for row in reader:
     count += 1
     stdout.write(str(count) + '\r')
 
+#compare with the relationships already on the server
+
+print('Comparing with existing relationships...')
+
+#patient ID -> {relative external ID: relative type}, so duplicate rows collapse into one relationship
+wanted_relatives = {}
+for patient_id, relative_obj in relatives:
+    wanted_relatives.setdefault(patient_id, {})[relative_obj['relative_of']] = relative_obj['relative_type']
+
+def get_existing_relatives(patient_id):
+    existing_relatives = {}
+    for relative_num in bot.list_relatives(patient_id):
+        relative_obj = bot.get_relative(patient_id, relative_num)
+        existing_relatives[relative_obj.get('relative_of')] = (relative_num, relative_obj.get('relative_type'))
+    return existing_relatives
+
+to_create = []
+to_update = []
+n_unchanged = 0
+
+for patient_id, existing_relatives in zip(wanted_relatives, map_concurrently(get_existing_relatives, wanted_relatives)):
+    for relative_eid, relative_type in wanted_relatives[patient_id].items():
+        relative_obj = {'relative_of': relative_eid, 'relative_type': relative_type}
+        if relative_eid not in existing_relatives:
+            to_create.append((patient_id, relative_obj))
+        elif existing_relatives[relative_eid][1] != relative_type:
+            to_update.append((patient_id, existing_relatives[relative_eid][0], relative_obj))
+        else:
+            n_unchanged += 1
+
+print(str(len(to_create)) + ' relationships to add, ' + str(len(to_update)) + ' to change, ' + str(n_unchanged) + ' already present.')
+if dry_run:
+    for patient_id, relative_obj in to_create:
+        print('ADD ' + patient_id + ' ' + relative_obj['relative_type'] + ' of ' + relative_obj['relative_of'])
+    for patient_id, relative_num, relative_obj in to_update:
+        print('CHANGE ' + patient_id + ' ' + relative_obj['relative_type'] + ' of ' + relative_obj['relative_of'])
+    exit(0)
+
 #begin import
 
-if yes or input('You are about to import ' + str(len(relatives)) + ' relationships. Type y to continue: ')[0] == 'y':
+n_changes = len(to_create) + len(to_update)
+if n_changes and (yes or input('You are about to import ' + str(n_changes) + ' relationships. Type y to continue: ')[0] == 'y'):
     count = 0
     start_time = time.time()
-    for relative in relatives:
-        bot.create_relative(relative[0], relative[1])
-        count += 1
+    #group the changes by patient so that each patient's page is written by only one thread
+    changes = {}
+    for patient_id, relative_obj in to_create:
+        changes.setdefault(patient_id, ([], []))[0].append(('PhenoTips.RelativeClass', relative_obj))
+    for patient_id, relative_num, relative_obj in to_update:
+        changes.setdefault(patient_id, ([], []))[1].append(('PhenoTips.RelativeClass', relative_num, relative_obj))
+
+    def apply_changes(patient_id, new_objects, changed_objects):
+        bot.create_objects(patient_id, new_objects)
+        bot.set_objects(patient_id, changed_objects)
+        return len(new_objects) + len(changed_objects)
+
+    for n_applied in map_concurrently(lambda change: apply_changes(change[0], *change[1]), changes.items()):
+        count += n_applied
         stdout.write(str(count) + '\r')
     print('All done! Elapsed time ' + str(timedelta(seconds=time.time() - start_time)))
@@ -18,27 +18,174 @@
 # Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301
 # USA
 
+import csv
+import gzip
+import hashlib
 import json
+import os
+import re
 import requests
+import sys
+import time
 from base64 import b64encode
 from collections import OrderedDict
+from collections import deque
+from collections.abc import Mapping
+from concurrent.futures import ThreadPoolExecutor
 from copy import copy
+from datetime import date
+from datetime import datetime
+from datetime import timedelta
+from functools import lru_cache
 from os.path import basename
-from selenium import webdriver
+from os.path import expanduser
+from os.path import join
+from requests.adapters import HTTPAdapter
+from threading import Event
+from threading import Lock
+from urllib.parse import urlencode
 from xml.etree import ElementTree
 
 class PhenoTipsBot:
     TIMEOUT = 20 #seconds
+    CHUNK_SIZE = 1024 * 1024 #bytes
+    MIN_COMPRESS_SIZE = 16 * 1024 #bytes, smaller uploads aren't worth compressing
+    #connections kept open to the server, enough for a streaming import's two pipeline stages of MAX_WORKERS threads
+    #and list_directory's counting threads to all run at once
+    MAX_WORKERS = 8
+    POOL_SIZE = 3 * MAX_WORKERS
+    CACHE_DIR = join(expanduser('~'), '.cache', 'phenotipsbot')
+    JSON_OR_XML = {'Accept': 'application/json, application/xml;q=0.9'}
+    #the tables that XWiki stores each type of class property in, StringProperty for the rest
+    PROPERTY_TABLES = {'Boolean': 'IntegerProperty', 'Date': 'DateProperty', 'TextArea': 'LargeStringProperty'}
+    NUMBER_TABLES = {'integer': 'IntegerProperty', 'long': 'LongProperty', 'float': 'FloatProperty', 'double': 'DoubleProperty'}
+    #list() can only filter on these types of property, and only on lists that allow a single choice, because the
+    #choices of the others are stored in tables of their own
+    SCALAR_TYPES = ('String', 'TextArea', 'Email', 'Number', 'Boolean', 'Date')
+    LIST_TYPES = ('StaticList', 'DBList', 'DBTreeList', 'Users', 'Groups', 'Page')
+    CACHE_FORMAT = 2 #changes whenever download_class_properties returns something new, so that old caches are ignored
 
     driver = None
 
-    def __init__(self, base_url, username, password, ssl_verify=True):
+    def __init__(self, base_url, username, password, ssl_verify=True, cache_dir=CACHE_DIR, compress_uploads=False):
         self.base = base_url
         self.auth = (username, password)
         self.ssl_verify = ssl_verify
+        self.cache_dir = cache_dir
+        self.compress_uploads = compress_uploads
+        self.stats = {
+            'requests': 0,
+            'wire_bytes_received': 0,
+            'payload_bytes_received': 0,
+            'wire_bytes_sent': 0,
+            'payload_bytes_sent': 0,
+        }
+        self.stats_lock = Lock()
+        #reuse connections between requests instead of opening a new one every time
+        self.session = self.new_session()
+        self.class_properties = {}
+        self.record_schemas = {}
+        self.directory = None
+
+    def add_stats(self, **counts):
+        with self.stats_lock:
+            for key, value in counts.items():
+                self.stats[key] += value
+
+    def compile_predicate(self, alias, predicate):
+        #turns (class_name, property_name, operator[, value]) into HQL with named parameters, accepting only properties
+        #that exist in the class, so that nothing from the caller can change the shape of the query
+        class_name, prop_name, operator = predicate[:3]
+        value = predicate[3] if len(predicate) > 3 else None
+        if not re.fullmatch(r'\w+\.\w+', class_name):
+            raise ValueError('Invalid class name "' + class_name + '"')
+        props = self.list_class_properties(class_name)
+        if prop_name not in props:
+            raise ValueError('Class ' + class_name + ' has no property "' + prop_name + '"')
+        prop_type = props[prop_name]['type']
+        if prop_type in PhenoTipsBot.LIST_TYPES and props[prop_name].get('multiSelect'):
+            raise ValueError('Cannot filter on ' + class_name + '.' + prop_name + ' because it allows several choices')
+        if prop_type not in PhenoTipsBot.SCALAR_TYPES + PhenoTipsBot.LIST_TYPES:
+            raise ValueError('Cannot filter on ' + class_name + '.' + prop_name + ' because it is a ' + prop_type + ' property')
+        if prop_type == 'Number':
+            table = PhenoTipsBot.NUMBER_TABLES.get(props[prop_name].get('numberType'), 'IntegerProperty')
+        else:
+            table = PhenoTipsBot.PROPERTY_TABLES.get(prop_type, 'StringProperty')
+        prop_value = alias + '_prop.value'
+        params = {alias + '_class': class_name, alias + '_name': prop_name}
+
+        if operator == '=':
+            condition = prop_value + ' = :' + alias + '_value'
+            params[alias + '_value'] = PhenoTipsBot.hql_value(value, table)
+        elif operator == 'in':
+            if value:
+                condition = prop_value + ' in :' + alias + '_value'
+                params[alias + '_value'] = [PhenoTipsBot.hql_value(item, table) for item in value]
+            else:
+                condition = '1 = 0'
+        elif operator in ('startswith', 'contains'):
+            pattern = str(value).lower().replace('!', '!!').replace('%', '!%').replace('_', '!_') + '%'
+            if operator == 'contains':
+                pattern = '%' + pattern
+            condition = 'lower(' + prop_value + ') like :' + alias + "_value escape '!'"
+            params[alias + '_value'] = pattern
+        elif operator == 'between':
+            start, end = value
+            conditions = []
+            if start != None:
+                conditions.append(prop_value + ' >= :' + alias + '_start')
+                params[alias + '_start'] = PhenoTipsBot.hql_value(start, table)
+            if end != None:
+                conditions.append(prop_value + ' <= :' + alias + '_end')
+                params[alias + '_end'] = PhenoTipsBot.hql_value(end, table)
+            condition = ' and '.join(conditions) or '1 = 1'
+        elif operator == 'nonempty':
+            condition = prop_value + ' is not null'
+            if table in ('StringProperty', 'LargeStringProperty'):
+                condition += ' and ' + prop_value + " <> ''"
+        else:
+            raise ValueError('Unknown operator "' + operator + '"')
+
+        from_clause = ', BaseObject as ' + alias + '_obj, ' + table + ' as ' + alias + '_prop'
+        where_clause = ' and doc.fullName = ' + alias + '_obj.name and ' + alias + '_obj.className = :' + alias + '_class'
+        where_clause += ' and ' + alias + '_obj.id = ' + alias + '_prop.id.id and ' + alias + '_prop.id.name = :' + alias + '_name'
+        where_clause += ' and ' + condition
+        return from_clause, where_clause, params
+
+    def compress_body(self, body, headers):
+        #the server has to be set up to accept compressed request bodies, so this is off unless compress_uploads is set
+        if self.compress_uploads and len(body) >= PhenoTipsBot.MIN_COMPRESS_SIZE:
+            headers['Content-Encoding'] = 'gzip'
+            return gzip.compress(body)
+        return body
+
+    def count_response(self, r, *args, **kwargs):
+        #counts how many bytes went over the network and how many bytes they were compressed from or decompressed to
+        body = r.request.body
+        if isinstance(body, str):
+            body = body.encode('utf-8')
+        wire_bytes_sent = len(body) if isinstance(body, bytes) else 0
+        if wire_bytes_sent and r.request.headers.get('Content-Encoding') == 'gzip':
+            #the last four bytes of a gzip stream are the uncompressed size
+            payload_bytes_sent = int.from_bytes(body[-4:], 'little')
+        else:
+            payload_bytes_sent = wire_bytes_sent
+        if kwargs.get('stream'):
+            #streamed downloads are counted by whoever reads them
+            wire_bytes_received = payload_bytes_received = 0
+        else:
+            payload_bytes_received = len(r.content)
+            wire_bytes_received = r.raw.tell() if hasattr(r.raw, 'tell') else payload_bytes_received
+        self.add_stats(
+            requests=1,
+            wire_bytes_received=wire_bytes_received,
+            payload_bytes_received=payload_bytes_received,
+            wire_bytes_sent=wire_bytes_sent,
+            payload_bytes_sent=payload_bytes_sent,
+        )
 
     def create(self, patient_obj=None, study=None, owner=None, pedigree=None):
-        r = requests.post(self.base + '/rest/patients', auth=self.auth, verify=self.ssl_verify)
+        r = self.session.post(self.base + '/rest/patients', auth=self.auth, verify=self.ssl_verify)
         r.raise_for_status()
         patient_id = r.headers['location']
         patient_id = patient_id[patient_id.rfind('/')+1:]
@@ -52,7 +199,7 @@ class PhenoTipsBot:
             self.set_pedigree(patient_id, pedigree)
         #the mandatory PhenoTips.VCF object is not added until someone visits the edit page
         url = self.base + '/bin/edit/data/' + patient_id
-        r = requests.get(url, auth=self.auth, verify=self.ssl_verify);
+        r = self.session.get(url, auth=self.auth, verify=self.ssl_verify);
         r.raise_for_status()
         return patient_id
 
@@ -67,12 +214,17 @@ class PhenoTipsBot:
         data = {'className': object_class}
         for key, value in object_obj.items():
             data['property#' + key] = value
-        r = requests.post(url, auth=self.auth, data=data, verify=self.ssl_verify)
+        r = self.session.post(url, auth=self.auth, data=data, verify=self.ssl_verify)
         r.raise_for_status()
         object_number = r.headers['location']
         object_number = object_number[object_number.rfind('/')+1:]
         return object_number
 
+    def create_objects(self, patient_id, objects):
+        #saving several objects on one page at the same time can lose some of them, so send them one after another
+        #over the bot's pooled connections
+        return [self.create_object(patient_id, object_class, object_obj) for object_class, object_obj in objects]
+
     def create_relative(self, patient_id, relative_obj):
         return self.create_object(patient_id, 'PhenoTips.RelativeClass', relative_obj)
 
@@ -80,7 +232,7 @@ class PhenoTipsBot:
         return self.create_object(patient_id, 'PhenoTips.VCF', vcf_obj)
 
     def delete(self, patient_id):
-        r = requests.delete(self.base + '/rest/patients/' + patient_id, auth=self.auth, verify=self.ssl_verify)
+        r = self.session.delete(self.base + '/rest/patients/' + patient_id, auth=self.auth, verify=self.ssl_verify)
         r.raise_for_status()
 
     def delete_collaborator(self, patient_id, collaborator_num):
@@ -88,12 +240,12 @@ class PhenoTipsBot:
 
     def delete_file(self, patient_id, filename):
         url = self.base + '/rest/wikis/xwiki/spaces/data/pages/' + patient_id + '/attachments/' + filename
-        r = requests.delete(url, auth=self.auth, verify=self.ssl_verify)
+        r = self.session.delete(url, auth=self.auth, verify=self.ssl_verify)
         r.raise_for_status()
 
     def delete_object(self, patient_id, object_class, object_num):
         url = self.base + '/rest/wikis/xwiki/spaces/data/pages/' + patient_id + '/objects/' + object_class + '/' + relative_num
-        r = requests.delete(url, auth=self.auth, verify=self.ssl_verify)
+        r = self.session.delete(url, auth=self.auth, verify=self.ssl_verify)
         r.raise_for_status()
 
     def delete_relative(self, patient_id, relative_num):
@@ -102,10 +254,67 @@ class PhenoTipsBot:
     def delete_vcf(self, patient_id, vcf_num):
         self.delete_object(patient_id, 'PhenoTips.VCF', vcf_num)
 
-    def download_file(self, patient_id, filename, outpath):
-        fd = open(outpath, "wb")
-        fd.write(self.get_file(patient_id, filename))
-        fd.close()
+    def download_class_properties(self, class_name):
+        url = self.base + '/rest/wikis/xwiki/classes/' + class_name
+        r = self.session.get(url, headers=PhenoTipsBot.JSON_OR_XML, auth=self.auth, verify=self.ssl_verify)
+        r.raise_for_status()
+        data, root = PhenoTipsBot.parse_response(r)
+        if data != None:
+            props = [
+                (prop['name'], prop['type'], {attr['name']: attr.get('value') for attr in prop.get('attributes', [])})
+                for prop in data['properties']
+            ]
+        else:
+            props = [
+                (prop.attrib['name'], prop.attrib['type'], {
+                    attr.attrib['name']: attr.attrib.get('value') for attr in prop.findall('./{http://www.xwiki.org}attribute')
+                })
+                for prop in root.iter('{http://www.xwiki.org}property')
+            ]
+        ret = OrderedDict()
+        for prop_name, prop_type, attrs in props:
+            ret[prop_name] = {'type': prop_type}
+
+            if attrs.get('multiSelect') != None:
+                ret[prop_name]['multiSelect'] = attrs['multiSelect'] in ('1', 'true')
+            if attrs.get('numberType') != None:
+                ret[prop_name]['numberType'] = attrs['numberType']
+            if attrs.get('validationRegExp') != None:
+                ret[prop_name]['validationRegExp'] = attrs['validationRegExp']
+            if attrs.get('values') != None:
+                ret[prop_name]['values'] = {}
+                for key_value_pair in attrs['values'].split('|'):
+                    key_value_pair = key_value_pair.split('=')
+                    if len(key_value_pair) > 1:
+                        key = key_value_pair[0]
+                        value = key_value_pair[1]
+                    else:
+                        key = value = key_value_pair[0]
+                    ret[prop_name]['values'][key] = value
+        return ret
+
+    def download_file(self, patient_id, filename, outpath, checksum=None, hash_name='sha256'):
+        #attachments can be several gigabytes, so write them to disk a piece at a time
+        url = self.base + '/bin/download/data/' + patient_id + '/' + filename
+        digest = hashlib.new(hash_name)
+        size = 0
+        with self.session.get(url, auth=self.auth, verify=self.ssl_verify, stream=True) as r:
+            r.raise_for_status()
+            with open(outpath + '.part', 'wb') as fd:
+                for chunk in r.iter_content(PhenoTipsBot.CHUNK_SIZE):
+                    fd.write(chunk)
+                    digest.update(chunk)
+                    size += len(chunk)
+            self.add_stats(wire_bytes_received=r.raw.tell(), payload_bytes_received=size)
+        if checksum and digest.hexdigest() != checksum.lower():
+            os.remove(outpath + '.part')
+            raise ValueError('Checksum mismatch downloading ' + filename + ' from patient ' + patient_id)
+        os.replace(outpath + '.part', outpath)
+        return digest.hexdigest()
+
+    def download_files(self, transfers, max_workers=4):
+        with ThreadPoolExecutor(max_workers) as executor:
+            return list(executor.map(lambda transfer: self.download_file(*transfer), transfers))
 
     def export_pedigree_ped(self, patient_id, id_generation='external'):
         self.init_phantom()
@@ -114,8 +323,18 @@ class PhenoTipsBot:
         self.driver.find_element_by_css_selector('#canvas svg') #wait for the page to load
         return self.driver.execute_script('return window.PedigreeExport.exportAsPED(window.editor.getGraph().DG, ' + json.dumps(id_generation) + ');')
 
-    def get(self, patient_id):
-        return self.get_object(patient_id, 'PhenoTips.PatientClass', '0')
+    def get(self, patient_id, compact=False):
+        return self.get_object(patient_id, 'PhenoTips.PatientClass', '0', compact)
+
+    def get_class_version(self, class_name):
+        space, page = class_name.split('.', 1)
+        url = self.base + '/rest/wikis/xwiki/spaces/' + space + '/pages/' + page
+        r = self.session.get(url, headers=PhenoTipsBot.JSON_OR_XML, auth=self.auth, verify=self.ssl_verify)
+        r.raise_for_status()
+        data, root = PhenoTipsBot.parse_response(r)
+        if data != None:
+            return data['version']
+        return root.find('{http://www.xwiki.org}version').text
 
     def get_collaborator(self, patient_id, collaborator_num):
         ret = self.get_object(patient_id, 'PhenoTips.CollaboratorClass', collaborator_num)
@@ -124,13 +343,13 @@ class PhenoTipsBot:
 
     def get_file(self, patient_id, filename):
         url = self.base + '/bin/download/data/' + patient_id + '/' + filename
-        r = requests.get(url, auth=self.auth, verify=self.ssl_verify)
+        r = self.session.get(url, auth=self.auth, verify=self.ssl_verify)
         r.raise_for_status()
         return r.content
 
     def get_id(self, external_id):
         url = self.base + '/rest/patients/eid/' + external_id
-        r = requests.get(url, auth=self.auth, verify=self.ssl_verify)
+        r = self.session.get(url, headers=PhenoTipsBot.JSON_OR_XML, auth=self.auth, verify=self.ssl_verify)
         if r.status_code == 404:
             return None
         r.raise_for_status()
@@ -144,15 +363,22 @@ class PhenoTipsBot:
         else:
             raise TypeError('Expected JSON or XML')
 
-    def get_object(self, patient_id, object_class, object_num):
+    def get_object(self, patient_id, object_class, object_num, compact=False):
         url = self.base + '/rest/wikis/xwiki/spaces/data/pages/' + patient_id + '/objects/' + object_class + '/' + object_num
-        r = requests.get(url, auth=self.auth, verify=self.ssl_verify)
+        r = self.session.get(url, headers=PhenoTipsBot.JSON_OR_XML, auth=self.auth, verify=self.ssl_verify)
         r.raise_for_status()
-        root = ElementTree.fromstring(r.text)
-        ret = {}
-        for prop in root.iter('{http://www.xwiki.org}property'):
-            ret[prop.attrib['name']] = prop.find('{http://www.xwiki.org}value').text
-        return ret
+        data, root = PhenoTipsBot.parse_response(r)
+        if data != None:
+            #XML gives None for an empty value and JSON gives an empty string, so make them the same
+            names = [prop['name'] for prop in data['properties']]
+            values = [prop.get('value') or None for prop in data['properties']]
+        else:
+            props = list(root.iter('{http://www.xwiki.org}property'))
+            names = [prop.attrib['name'] for prop in props]
+            values = [prop.find('{http://www.xwiki.org}value').text for prop in props]
+        if compact:
+            return Record(self.get_record_schema(names), tuple(values))
+        return dict(zip(names, values))
 
     def get_owner(self, patient_id):
         return PhenoTipsBot.unqualify(self.get_object(patient_id, 'PhenoTips.OwnerClass', '0')['owner'])
@@ -160,22 +386,32 @@ class PhenoTipsBot:
     def get_pedigree(self, patient_id):
         return json.loads(self.get_object(patient_id, 'PhenoTips.PedigreeClass', '0')['data'])
 
+    def get_record_schema(self, names):
+        #objects of the same class nearly always have the same properties, so they can share one schema
+        names = tuple(names)
+        if names not in self.record_schemas:
+            self.record_schemas[names] = RecordSchema(names)
+        return self.record_schemas[names]
+
     def get_relative(self, patient_id, relative_num):
         return self.get_object(patient_id, 'PhenoTips.RelativeClass', relative_num)
 
     def get_study(self, patient_id):
         url = self.base + '/rest/wikis/xwiki/spaces/data/pages/' + patient_id + '/objects/PhenoTips.StudyBindingClass/0'
-        r = requests.get(url, auth=self.auth, verify=self.ssl_verify)
+        r = self.session.get(url, headers=PhenoTipsBot.JSON_OR_XML, auth=self.auth, verify=self.ssl_verify)
         if r.status_code == 404:
             return None
         else:
             r.raise_for_status()
-            root = ElementTree.fromstring(r.text)
-            el = root.find('{http://www.xwiki.org}property[@name="studyReference"]/{http://www.xwiki.org}value')
-            if not el.text:
+            data, root = PhenoTipsBot.parse_response(r)
+            if data != None:
+                study = next(prop.get('value') for prop in data['properties'] if prop['name'] == 'studyReference')
+            else:
+                study = root.find('{http://www.xwiki.org}property[@name="studyReference"]/{http://www.xwiki.org}value').text
+            if not study:
                 return ''
             else:
-                return PhenoTipsBot.unqualify(el.text, 'Studies')
+                return PhenoTipsBot.unqualify(study, 'Studies')
 
     def get_vcf(self, patient_id, vcf_num):
         return self.get_object(patient_id, 'PhenoTips.VCF', vcf_num)
@@ -197,13 +433,19 @@ class PhenoTipsBot:
 
     def init_phantom(self):
         if not self.driver:
+            #selenium is slow to import and only the pedigree functions need it
+            from selenium import webdriver
             authorization = 'Basic ' + b64encode((self.auth[0] + ':' + self.auth[1]).encode('utf-8')).decode('utf-8')
             webdriver.DesiredCapabilities.PHANTOMJS['phantomjs.page.customHeaders.authorization'] = authorization
             self.driver = webdriver.PhantomJS()
             self.driver.set_window_size(1920, 1080) #big enough to not cut off any elements
             self.driver.implicitly_wait(PhenoTipsBot.TIMEOUT)
 
-    def list(self, study=None, owner=None, having_object=None):
+    def list(self, study=None, owner=None, having_object=None, since=None, where=None):
+        predicates = [self.compile_predicate('where' + str(i), predicate) for i, predicate in enumerate(where or [])]
+        #the query text only depends on which filters are used and every value is a :named parameter, so list_hql is the
+        #one place that quotes values and nothing from the caller can change the shape of the query
+        params = {}
         query = ", BaseObject as obj"
         if study != None:
             query += ", BaseObject as study_obj, StringProperty as study_prop"
@@ -211,76 +453,147 @@ class PhenoTipsBot:
             query += ", BaseObject as owner_obj, StringProperty as owner_prop"
         if having_object:
             query += ", BaseObject as needful_obj"
+        for from_clause, where_clause, predicate_params in predicates:
+            query += from_clause
         query += " where doc.space = 'data' and doc.fullName = obj.name and obj.className = 'PhenoTips.PatientClass'"
         if having_object:
-            query += " and doc.fullName = needful_obj.name and needful_obj.className = '" + having_object + "'"
+            query += " and doc.fullName = needful_obj.name and needful_obj.className = :having_object"
+            params['having_object'] = having_object
         if study != None:
             query += " and doc.fullName = study_obj.name and study_obj.className = 'PhenoTips.StudyBindingClass'"
             query += " and study_obj.id = study_prop.id.id and study_prop.id.name = 'studyReference'"
-            query += " and study_prop.value = 'xwiki:Studies." + study + "'"
+            query += " and study_prop.value = :study"
+            params['study'] = 'xwiki:Studies.' + study
         if owner:
             query += " and doc.fullName = owner_obj.name and owner_obj.className = 'PhenoTips.OwnerClass'"
             query += " and owner_obj.id = owner_prop.id.id and owner_prop.id.name = 'owner'"
-            query += " and owner_prop.value = '" + PhenoTipsBot.qualify(owner) + "'"
-        return list(map(lambda pagename: PhenoTipsBot.unqualify(pagename, 'data'), self.list_hql(query)))
+            query += " and owner_prop.value = :owner"
+            params['owner'] = PhenoTipsBot.qualify(owner)
+        if since:
+            query += " and doc.date > :since"
+            params['since'] = since
+        for from_clause, where_clause, predicate_params in predicates:
+            query += where_clause
+            params.update(predicate_params)
+        #a patient with several matching objects comes back once for each of them
+        pagenames = OrderedDict.fromkeys(self.list_hql(query, params))
+        return list(map(lambda pagename: PhenoTipsBot.unqualify(pagename, 'data'), pagenames))
 
     def list_class_properties(self, class_name):
-        url = self.base + '/rest/wikis/xwiki/classes/' + class_name
-        r = requests.get(url, auth=self.auth, verify=self.ssl_verify)
-        r.raise_for_status()
-        root = ElementTree.fromstring(r.text)
-        ret = OrderedDict()
-        for prop in root.iter('{http://www.xwiki.org}property'):
-            prop_name = prop.attrib['name']
-            ret[prop_name] = {'type': prop.attrib['type']}
-
-            number_type_el = prop.find('./{http://www.xwiki.org}attribute[@name="numberType"]')
-            regex_el = prop.find('./{http://www.xwiki.org}attribute[@name="validationRegExp"]')
-            values_el = prop.find('./{http://www.xwiki.org}attribute[@name="values"]')
-
-            if number_type_el != None:
-                ret[prop_name]['numberType'] = number_type_el.attrib['value']
-            if regex_el != None:
-                ret[prop_name]['validationRegExp'] = regex_el.attrib['value']
-            if values_el != None:
-                ret[prop_name]['values'] = {}
-                for key_value_pair in values_el.attrib['value'].split('|'):
-                    key_value_pair = key_value_pair.split('=')
-                    if len(key_value_pair) > 1:
-                        key = key_value_pair[0]
-                        value = key_value_pair[1]
-                    else:
-                        key = value = key_value_pair[0]
-                    ret[prop_name]['values'][key] = value
-        return ret
+        if class_name in self.class_properties:
+            return self.class_properties[class_name]
+
+        if not self.cache_dir:
+            self.class_properties[class_name] = self.download_class_properties(class_name)
+            return self.class_properties[class_name]
+
+        #the class rarely changes, so keep a copy on disk and only download it again if the page version changes
+        version = self.get_class_version(class_name)
+        cache_path = join(self.cache_dir, hashlib.sha1(self.base.encode('utf-8')).hexdigest(), class_name + '.json')
+        try:
+            with open(cache_path, 'r') as cache_file:
+                cache = json.load(cache_file, object_pairs_hook=OrderedDict)
+            if cache['version'] == version and cache.get('format') == PhenoTipsBot.CACHE_FORMAT:
+                self.class_properties[class_name] = cache['properties']
+                return cache['properties']
+        except (OSError, ValueError, KeyError):
+            pass
+
+        properties = self.download_class_properties(class_name)
+        try:
+            os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+            with open(cache_path + '.tmp', 'w') as cache_file:
+                json.dump({'format': PhenoTipsBot.CACHE_FORMAT, 'version': version, 'properties': properties}, cache_file)
+            os.replace(cache_path + '.tmp', cache_path)
+        except OSError:
+            pass
+        self.class_properties[class_name] = properties
+        return properties
 
     def list_collaborators(self, patient_id):
         return self.list_objects(patient_id, 'PhenoTips.CollaboratorClass')
 
+    def list_directory(self, counts=False):
+        if self.directory == None:
+            #one query for all three kinds of pages instead of one query each
+            query = ", BaseObject as obj where doc.fullName = obj.name and ("
+            query += "(doc.space = 'Studies' and obj.className = 'PhenoTips.StudyClass') or "
+            query += "(doc.space = 'XWiki' and obj.className = 'XWiki.XWikiUsers') or "
+            query += "(doc.space = 'Groups' and obj.className = 'PhenoTips.PhenoTipsGroupClass'))"
+            directory = {'studies': [], 'users': [], 'groups': []}
+            for pagename in self.list_hql(query):
+                for space, key in (('Studies', 'studies'), ('XWiki', 'users'), ('Groups', 'groups')):
+                    if pagename.startswith('xwiki:' + space + '.'):
+                        directory[key].append(PhenoTipsBot.unqualify(pagename, space))
+            self.directory = directory
+
+        if counts and not 'owner_counts' in self.directory:
+            #the query API can't count, so list the patients of each owner and study at the same time
+            owners = self.directory['users'] + ['Groups.' + group for group in self.directory['groups']]
+            studies = self.directory['studies']
+            with ThreadPoolExecutor(PhenoTipsBot.MAX_WORKERS) as executor:
+                owner_counts = executor.map(lambda owner: len(self.list(owner=owner)), owners)
+                study_counts = executor.map(lambda study: len(self.list(study=study)), studies)
+                self.directory['owner_counts'] = OrderedDict(zip(owners, owner_counts))
+                self.directory['study_counts'] = OrderedDict(zip(studies, study_counts))
+
+        return self.directory
+
+    def list_files(self, patient_id):
+        url = self.base + '/rest/wikis/xwiki/spaces/data/pages/' + patient_id + '/attachments'
+        r = self.session.get(url, headers=PhenoTipsBot.JSON_OR_XML, auth=self.auth, verify=self.ssl_verify)
+        r.raise_for_status()
+        data, root = PhenoTipsBot.parse_response(r)
+        ret = OrderedDict()
+        if data != None:
+            for attachment in data['attachments']:
+                ret[attachment['name']] = {'size': int(attachment['size']), 'version': attachment['version']}
+        else:
+            for attachment in root.iter('{http://www.xwiki.org}attachment'):
+                ret[attachment.find('{http://www.xwiki.org}name').text] = {
+                    'size': int(attachment.find('{http://www.xwiki.org}size').text),
+                    'version': attachment.find('{http://www.xwiki.org}version').text,
+                }
+        return ret
+
     def list_groups(self):
         return self.list_pages('Groups', 'PhenoTips.PhenoTipsGroupClass')
 
-    def list_hql(self, query):
+    def list_hql(self, query, params=None):
+        #the REST API only takes the text of the query, so bind the :named parameters to it here, where every value is
+        #quoted the same way
+        parts, names = prepare_hql(query)
+        if names:
+            params = params or {}
+            missing = [name for name in names if name not in params]
+            if missing:
+                raise ValueError('No value for query parameters ' + ', '.join(missing))
+            query = parts[0] + ''.join(PhenoTipsBot.hql_literal(params[name]) + part for name, part in zip(names, parts[1:]))
         url = self.base + '/rest/wikis/xwiki/query'
-        r = requests.get(url, params={'q': query, 'type': 'hql'}, auth=self.auth, verify=self.ssl_verify)
+        r = self.session.get(url, params={'q': query, 'type': 'hql'}, headers=PhenoTipsBot.JSON_OR_XML, auth=self.auth, verify=self.ssl_verify)
         r.raise_for_status()
-        root = ElementTree.fromstring(r.text)
+        data, root = PhenoTipsBot.parse_response(r)
+        if data != None:
+            return [result['id'] for result in data['searchResults']]
         id_elements = root.findall('./{http://www.xwiki.org}searchResult/{http://www.xwiki.org}id')
         return list(map(lambda el: el.text, id_elements))
 
     def list_objects(self, patient_id, object_class):
         url = self.base + '/rest/wikis/xwiki/spaces/data/pages/' + patient_id + '/objects/' + object_class
-        r = requests.get(url, auth=self.auth, verify=self.ssl_verify)
+        r = self.session.get(url, headers=PhenoTipsBot.JSON_OR_XML, auth=self.auth, verify=self.ssl_verify)
         r.raise_for_status()
-        root = ElementTree.fromstring(r.text)
+        data, root = PhenoTipsBot.parse_response(r)
+        if data != None:
+            return [str(summary['number']) for summary in data['objectSummaries']]
         number_elements = root.findall('./{http://www.xwiki.org}objectSummary/{http://www.xwiki.org}number')
         return list(map(lambda el: el.text, number_elements))
 
     def list_pages(self, space, having_object=None):
-        query = ", BaseObject as obj where doc.space = '" + space + "'"
+        query = ", BaseObject as obj where doc.space = :space"
         if having_object:
-            query += " and doc.fullName = obj.name and obj.className = '" + having_object + "'"
-        return list(map(lambda pagename: PhenoTipsBot.unqualify(pagename, space), self.list_hql(query)))
+            query += " and doc.fullName = obj.name and obj.className = :having_object"
+        params = {'space': space, 'having_object': having_object}
+        return list(map(lambda pagename: PhenoTipsBot.unqualify(pagename, space), self.list_hql(query, params)))
 
     def list_patient_class_properties(self):
         return self.list_class_properties('PhenoTips.PatientClass')
@@ -297,6 +610,18 @@ class PhenoTipsBot:
     def list_vcfs(self, patient_id):
         return self.list_objects(patient_id, 'PhenoTips.VCF')
 
+    def new_session(self):
+        session = requests.Session()
+        #requests asks for compressed responses by default, but say so explicitly in case that default ever changes
+        session.headers['Accept-Encoding'] = 'gzip, deflate'
+        #the default pool only keeps 10 connections and throws away the rest, which would undo the pooling when the
+        #pipelines run more threads than that
+        adapter = HTTPAdapter(pool_maxsize=PhenoTipsBot.POOL_SIZE)
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        session.hooks['response'].append(self.count_response)
+        return session
+
     def set(self, patient_id, patient_obj):
         self.set_object(patient_id, 'PhenoTips.PatientClass', '0', patient_obj)
 
@@ -307,8 +632,12 @@ class PhenoTipsBot:
         self.set_object(patient_id, 'PhenoTips.CollaboratorClass', collaborator_num, collaborator_obj)
 
     def set_file(self, patient_id, filename, contents):
+        #contents can be bytes or a file object, which requests sends a piece at a time
         url = self.base + '/rest/wikis/xwiki/spaces/data/pages/' + patient_id + '/attachments/' + filename
-        r = requests.put(url, auth=self.auth, data=contents, verify=self.ssl_verify)
+        headers = {}
+        if isinstance(contents, bytes):
+            contents = self.compress_body(contents, headers)
+        r = self.session.put(url, headers=headers, auth=self.auth, data=contents, verify=self.ssl_verify)
         r.raise_for_status()
 
     def set_object(self, patient_id, object_class, object_num, object_obj):
@@ -316,9 +645,19 @@ class PhenoTipsBot:
         data = {}
         for key, value in object_obj.items():
             data['property#' + key] = value
-        r = requests.put(url, auth=self.auth, data=data, verify=self.ssl_verify)
+        headers = {}
+        if self.compress_uploads:
+            #encode the form ourselves so that it can be compressed, leaving out None values as requests does
+            headers['Content-Type'] = 'application/x-www-form-urlencoded'
+            data = urlencode({key: value for key, value in data.items() if value != None})
+            data = self.compress_body(data.encode('utf-8'), headers)
+        r = self.session.put(url, headers=headers, auth=self.auth, data=data, verify=self.ssl_verify)
         r.raise_for_status()
 
+    def set_objects(self, patient_id, objects):
+        for object_class, object_num, object_obj in objects:
+            self.set_object(patient_id, object_class, object_num, object_obj)
+
     def set_owner(self, patient_id, owner):
         owner_name = PhenoTipsBot.qualify(owner)
         self.set_object(patient_id, 'PhenoTips.OwnerClass', '0', {'owner': owner})
@@ -339,7 +678,7 @@ class PhenoTipsBot:
 
     def set_study(self, patient_id, study):
         url = self.base + '/rest/wikis/xwiki/spaces/data/pages/' + patient_id + '/objects/PhenoTips.StudyBindingClass/0'
-        r = requests.get(url, auth=self.auth, verify=self.ssl_verify)
+        r = self.session.get(url, auth=self.auth, verify=self.ssl_verify)
         if r.status_code == 404:
             if study == None:
                 return
@@ -349,20 +688,166 @@ class PhenoTipsBot:
         else:
             r.raise_for_status()
             if study == None:
-                requests.delete(url, auth=self.auth, verify=self.ssl_verify)
+                self.session.delete(url, auth=self.auth, verify=self.ssl_verify)
                 r.raise_for_status()
             else:
                 data = {'property#studyReference': PhenoTipsBot.qualify(study, 'Studies')}
-                r = requests.put(url, auth=self.auth, data=data, verify=self.ssl_verify)
+                r = self.session.put(url, auth=self.auth, data=data, verify=self.ssl_verify)
                 r.raise_for_status()
 
     def set_vcf(self, patient_id, vcf_num, vcf_obj):
         self.set_object(patient_id, 'PhenoTips.VCF', vcf_num, vcf_obj)
 
+    def update(self, patient_id, patient_obj, current_obj=None):
+        #every write bumps the page version and reindexes the patient, so only send the properties that differ
+        if current_obj == None:
+            current_obj = self.get(patient_id)
+        props = self.list_patient_class_properties()
+        changes = {}
+        for key, value in patient_obj.items():
+            prop = props.get(key)
+            if PhenoTipsBot.comparable_value(value, prop) != PhenoTipsBot.comparable_value(current_obj.get(key), prop):
+                changes[key] = value
+        if changes:
+            self.set(patient_id, changes)
+        return changes
+
+    def upload_changed_file(self, patient_id, filepath, manifest):
+        return self.upload_changed_patient_files(patient_id, [filepath], manifest)[0]
+
+    def upload_changed_files(self, transfers, manifest_path, max_workers=4):
+        try:
+            with open(manifest_path, 'r') as manifest_file:
+                manifest = json.load(manifest_file)
+        except FileNotFoundError:
+            manifest = {}
+        try:
+            filepaths = PhenoTipsBot.group_transfers(transfers)
+            with ThreadPoolExecutor(max_workers) as executor:
+                results = executor.map(
+                    lambda patient_id: iter(self.upload_changed_patient_files(patient_id, filepaths[patient_id], manifest)),
+                    filepaths
+                )
+                results = dict(zip(filepaths, results))
+            return [next(results[patient_id]) for patient_id, filepath in transfers]
+        finally:
+            #save whatever was uploaded, even if some uploads failed
+            with open(manifest_path + '.tmp', 'w') as manifest_file:
+                json.dump(manifest, manifest_file, indent=1, sort_keys=True)
+            os.replace(manifest_path + '.tmp', manifest_path)
+
+    def upload_changed_patient_files(self, patient_id, filepaths, manifest):
+        #the manifest remembers the hash of every file uploaded before and the attachment version it became
+        #the files are attachments of the same page, so upload them one after another and only list the attachments
+        #before the first upload and after the last one
+        attachments = self.list_files(patient_id)
+        uploaded = []
+        results = []
+        try:
+            for filepath in filepaths:
+                filename = basename(filepath)
+                key = patient_id + '/' + filename
+                stat = os.stat(filepath)
+                entry = manifest.get(key)
+                if not entry or entry['size'] != stat.st_size or entry['mtime'] != stat.st_mtime:
+                    digest = hashlib.sha256()
+                    with open(filepath, 'rb') as fd:
+                        for chunk in iter(lambda: fd.read(PhenoTipsBot.CHUNK_SIZE), b''):
+                            digest.update(chunk)
+                    digest = digest.hexdigest()
+                else:
+                    digest = entry['sha256']
+
+                attachment = attachments.get(filename)
+                if (entry and attachment and entry['sha256'] == digest and
+                        entry['version'] == attachment['version'] and entry['size'] == attachment['size']):
+                    results.append(False)
+                    continue
+
+                self.upload_file(patient_id, filepath)
+                #the version is only known once the server has listed the new attachment
+                manifest[key] = {'sha256': digest, 'size': stat.st_size, 'mtime': stat.st_mtime, 'version': None}
+                uploaded.append(filename)
+                results.append(True)
+        finally:
+            if uploaded:
+                attachments = self.list_files(patient_id)
+                for filename in uploaded:
+                    manifest[patient_id + '/' + filename]['version'] = attachments[filename]['version']
+        return results
+
     def upload_file(self, patient_id, filepath):
-        fd = open(filepath, "rb")
-        self.set_file(patient_id, basename(filepath), fd.read())
-        fd.close()
+        with open(filepath, 'rb') as fd:
+            self.set_file(patient_id, basename(filepath), fd)
+
+    def upload_files(self, transfers, max_workers=4):
+        #send different patients' files at once, but each patient's files one after another because they are
+        #attachments of the same page
+        filepaths = PhenoTipsBot.group_transfers(transfers)
+        def upload_patient_files(patient_id):
+            for filepath in filepaths[patient_id]:
+                self.upload_file(patient_id, filepath)
+        with ThreadPoolExecutor(max_workers) as executor:
+            for future in [executor.submit(upload_patient_files, patient_id) for patient_id in filepaths]:
+                future.result()
+
+    def comparable_value(value, prop=None):
+        #the server sends values back in its own format, for example dates with a time of day, so compare them by the
+        #type of the property instead of as strings
+        if value == None or value == '':
+            return None
+        value = str(value).strip()
+        prop_type = prop['type'] if prop else None
+        try:
+            if prop_type == 'Date':
+                return parse_date(value)
+            if prop_type == 'Number':
+                return int(value) if prop.get('numberType') in ('integer', 'long') else float(value)
+            if prop_type == 'Boolean':
+                return 1 if value.lower() in ('1', 'true') else 0
+        except (ValueError, OverflowError):
+            pass
+        return value
+
+    def group_transfers(transfers):
+        #turns (patient_id, filepath) pairs into the file paths of each patient, in the order they were given
+        filepaths = OrderedDict()
+        for patient_id, filepath in transfers:
+            filepaths.setdefault(patient_id, []).append(filepath)
+        return filepaths
+
+    def hql_literal(value):
+        #every value in a query is quoted here, so that a quote in a value can't end the string early
+        if isinstance(value, (list, tuple)):
+            return '(' + ', '.join(map(PhenoTipsBot.hql_literal, value)) + ')'
+        if isinstance(value, bool):
+            return str(int(value))
+        if isinstance(value, (int, float)):
+            return repr(value)
+        if hasattr(value, 'strftime'):
+            value = value.strftime('%Y-%m-%d %H:%M:%S')
+        value = str(value)
+        #some databases treat a backslash as an escape character in strings and others don't, so there is no safe way
+        #to quote one
+        if '\\' in value:
+            raise ValueError('Query values cannot contain backslashes')
+        return "'" + value.replace("'", "''") + "'"
+
+    def hql_value(value, table='StringProperty'):
+        #converts a value to the type that the property is stored as
+        if table in ('IntegerProperty', 'LongProperty'):
+            return int(value)
+        if table in ('FloatProperty', 'DoubleProperty'):
+            return float(value)
+        if table == 'DateProperty' and hasattr(value, 'strftime'):
+            return value
+        return str(value)
+
+    def parse_response(r):
+        #JSON is much faster to parse than namespaced XML, but older servers only send XML, so handle both
+        if r.headers.get('content-type', '').split(';')[0] == 'application/json':
+            return r.json(), None
+        return None, ElementTree.fromstring(r.text)
 
     def qualify(pagename, namespace='XWiki'):
         if not pagename:
@@ -379,6 +864,40 @@ class PhenoTipsBot:
         if pagename.startswith('xwiki:'):
             return pagename[len('xwiki:'):]
 
+class RecordSchema:
+    __slots__ = ('names', 'indexes')
+
+    def __init__(self, names):
+        self.names = tuple(sys.intern(name) for name in names)
+        self.indexes = {name: i for i, name in enumerate(self.names)}
+
+class Record(Mapping):
+    __slots__ = ('schema', 'row')
+
+    def __init__(self, schema, row):
+        self.schema = schema
+        self.row = row
+
+    def __getitem__(self, key):
+        return self.row[self.schema.indexes[key]]
+
+    def __iter__(self):
+        return iter(self.schema.names)
+
+    def __len__(self):
+        return len(self.schema.names)
+
+    def __contains__(self, key):
+        return key in self.schema.indexes
+
+    def __repr__(self):
+        return 'Record(' + repr(dict(self)) + ')'
+
+    def get_list(self, key, separator='|'):
+        #list properties such as phenotype are only split when someone asks for them
+        value = self.get(key)
+        return value.split(separator) if value else []
+
 class ApgarType:
     unknown = 'unknown'
 
@@ -397,3 +916,984 @@ class SexType:
     male = 'M'
     female = 'F'
     other = 'O'
+
+ISO_DATE_REGEX = re.compile(r'(\d{4})-(\d{1,2})-(\d{1,2})(?:[ T]\d{1,2}:\d{2}(?::\d{2}(?:\.\d+)?)?)?')
+US_DATE_REGEX = re.compile(r'(\d{1,2})/(\d{1,2})/(\d{4})')
+HQL_PARAMETER_REGEX = re.compile(r"'(?:[^']|'')*'|:(\w+)")
+#an incremental export saves a time this much before it started, so that the next one can't miss a patient that was
+#saved while it ran or stamped by a server whose clock is a little behind
+EXPORT_OVERLAP = timedelta(hours=1)
+
+@lru_cache(maxsize=4096)
+def parse_date(date_str):
+    #nearly every date is ISO or US style, and dateutil is slow, so try those first
+    #a date that only looks like one of them, such as the day-first 20/02/2015, is left to dateutil as well
+    match = ISO_DATE_REGEX.fullmatch(date_str)
+    if match:
+        try:
+            return date(int(match.group(1)), int(match.group(2)), int(match.group(3)))
+        except ValueError:
+            pass
+    match = US_DATE_REGEX.fullmatch(date_str)
+    if match:
+        try:
+            return date(int(match.group(3)), int(match.group(1)), int(match.group(2)))
+        except ValueError:
+            pass
+    from dateutil.parser import parse as parsedate
+    return parsedate(date_str).date()
+
+@lru_cache(maxsize=256)
+def prepare_hql(query):
+    #splits a query into the text around its :named parameters, skipping quoted strings
+    parts = []
+    names = []
+    position = 0
+    for match in HQL_PARAMETER_REGEX.finditer(query):
+        if match.group(1):
+            parts.append(query[position:match.start()])
+            names.append(match.group(1))
+            position = match.end()
+    parts.append(query[position:])
+    return tuple(parts), tuple(names)
+
+def begin_export(list_patients, since=None, state_path=None, deleted_path=None):
+    #list_patients(since) has to apply the same filters whether or not since is given, so that the patients that are
+    #gone since the last export can be found by comparing the two lists
+    export_time = datetime.now() - EXPORT_OVERLAP
+    state = read_export_state(state_path) if state_path else {'since': since, 'patient_ids': []}
+    patient_ids = list_patients(state['since'])
+    all_patient_ids = list_patients(None) if state['since'] and state_path else patient_ids
+    if deleted_path:
+        with open(deleted_path, 'w') as deleted_file:
+            for patient_id in sorted(set(state['patient_ids']) - set(all_patient_ids)):
+                deleted_file.write(patient_id + '\n')
+    return patient_ids, all_patient_ids, state, export_time
+
+def parse_since(value):
+    #--since is either a timestamp or the path of a file that remembers the last export
+    from dateutil.parser import parse as parsedate
+    try:
+        return parsedate(value), None
+    except (ValueError, OverflowError):
+        return None, value
+
+def read_export_state(state_path):
+    #returns the state saved by the last export, with since set to None and no patients if there wasn't one
+    try:
+        with open(state_path, 'r') as state_file:
+            state = json.load(state_file)
+    except FileNotFoundError:
+        return {'since': None, 'patient_ids': []}
+    state['since'] = datetime.fromisoformat(state['since'])
+    return state
+
+def write_export_state(state_path, since, patient_ids, **extra):
+    state = dict(extra, since=since.isoformat(), patient_ids=sorted(patient_ids))
+    with open(state_path + '.tmp', 'w') as state_file:
+        json.dump(state, state_file)
+    os.replace(state_path + '.tmp', state_path)
+
+#The functions below are the stages of an import or export pipeline. Each one takes an iterable and returns a
+#generator, so that stages can be chained together and records are processed as they arrive instead of all at once.
+
+def fetch_patients(bot, patient_ids, compact=False, max_workers=PhenoTipsBot.MAX_WORKERS, cancel_event=None):
+    #source: yields (patient_id, patient_obj) in the same order as patient_ids
+    return map_concurrently(
+        lambda patient_id: (patient_id, bot.get(patient_id, compact)), patient_ids, max_workers, cancel_event
+    )
+
+def map_concurrently(function, items, max_workers=PhenoTipsBot.MAX_WORKERS, cancel_event=None, window=None):
+    #yields function(item) for each item in order, running up to max_workers calls at a time and reading at most
+    #window items ahead, so that items can be a stream of any length
+    if max_workers <= 1:
+        for item in items:
+            if cancel_event and cancel_event.is_set():
+                return
+            yield function(item)
+        return
+
+    window = window or max_workers * 4
+    with ThreadPoolExecutor(max_workers) as executor:
+        futures = deque()
+        try:
+            for item in items:
+                if cancel_event and cancel_event.is_set():
+                    break
+                futures.append(executor.submit(function, item))
+                if len(futures) >= window:
+                    yield futures.popleft().result()
+            while futures:
+                future = futures.popleft()
+                #after cancelling, skip the calls that haven't started yet but still report the ones that have
+                if cancel_event and cancel_event.is_set() and future.cancel():
+                    continue
+                yield future.result()
+        finally:
+            #don't start the calls that nobody is going to read
+            for future in futures:
+                future.cancel()
+
+def resolve_patient_ids(bot, patient_objs, max_workers=PhenoTipsBot.MAX_WORKERS, cancel_event=None):
+    #yields (patient_id, patient_obj), where patient_id is None if no patient has the same external ID
+    def resolve(patient_obj):
+        external_id = patient_obj.get('external_id')
+        return (bot.get_id(external_id) if external_id else None), patient_obj
+    return map_concurrently(resolve, patient_objs, max_workers, cancel_event)
+
+def save_patients(bot, resolved_patients, study=None, owner=None, max_workers=PhenoTipsBot.MAX_WORKERS, cancel_event=None):
+    #sink: creates the patients without an ID and updates the rest, yielding (patient_id, result) where result is
+    #'created', 'changed', or 'unchanged'
+    def chain(resolved_patients):
+        #rows for the same patient are saved one after another in the order they were given: each row waits for the
+        #previous row with the same external ID or patient ID, and updates the patient if that row created it
+        last_saves = {}
+        for patient_id, patient_obj in resolved_patients:
+            key = patient_obj.get('external_id') or patient_id
+            this_save = {'done': Event(), 'patient_id': patient_id}
+            yield patient_obj, this_save, last_saves.get(key)
+            if key:
+                last_saves[key] = this_save
+
+    def save(chained_patient):
+        patient_obj, this_save, last_save = chained_patient
+        try:
+            if last_save:
+                #the previous row was submitted first, so it is already running and this can't deadlock
+                last_save['done'].wait()
+                this_save['patient_id'] = this_save['patient_id'] or last_save['patient_id']
+            patient_id = this_save['patient_id']
+            if patient_id:
+                return patient_id, 'changed' if bot.update(patient_id, patient_obj) else 'unchanged'
+            this_save['patient_id'] = bot.create(patient_obj, study, owner)
+            return this_save['patient_id'], 'created'
+        finally:
+            this_save['done'].set()
+
+    return map_concurrently(save, chain(resolved_patients), max_workers, cancel_event)
+
+#The functions below import and export whole spreadsheets. The sample programs and the GUI are thin wrappers around
+#them.
+
+BOOLEAN_VALUES = {
+    't': '1', 'true': '1', 'y': '1', 'yes': '1', '1': '1',
+    'f': '0', 'false': '0', 'n': '0', 'no': '0', '0': '0',
+}
+
+def compile_normalizer(field_metadata):
+    field_type = field_metadata['type']
+    if field_type == 'Date':
+        def normalize(field_value):
+            return parse_date(field_value).strftime('%Y-%m-%d')
+    elif field_type == 'Boolean':
+        normalize = lambda field_value: BOOLEAN_VALUES.get(field_value.lower())
+    elif field_type == 'Number':
+        if field_metadata.get('numberType') in ('integer', 'long'):
+            normalize = int
+        else:
+            normalize = float
+    elif field_type == 'StaticList':
+        possible_values = field_metadata.get('values')
+        if not possible_values:
+            normalize = lambda field_value: field_value
+        else:
+            #map every spelling of a key or value to its key, letting earlier keys win
+            keys = {}
+            for key, value in possible_values.items():
+                keys.setdefault(key.lower(), key)
+                keys.setdefault(value.lower(), key)
+            normalize = lambda field_value: keys.get(field_value.lower())
+    else:
+        validation_regex = field_metadata.get('validationRegExp')
+        if validation_regex:
+            validation_regex = re.compile(validation_regex)
+            normalize = lambda field_value: field_value if validation_regex.fullmatch(field_value) else None
+        else:
+            normalize = lambda field_value: field_value
+
+    def normalize_or_none(field_value):
+        try:
+            return normalize(field_value.strip())
+        except ValueError:
+            return None
+
+    return normalize_or_none
+
+def iter_csv_file(bot, file_name, unrecognized_column_callback, unrecognized_value_callback,
+                  identifier_column_callback):
+    #open the file and check the header now, so that a missing file or a misspelled column is reported before the
+    #import starts instead of when the first row is read
+    possible_fields = bot.list_patient_class_properties()
+
+    in_file = open(file_name, 'r')
+    reader = csv.reader(in_file)
+    fieldnames = next(reader, [])
+
+    #warn about unrecognized fields and work out how to normalize the rest
+    columns = []
+    for index, field in enumerate(fieldnames):
+        if field == 'identifier':
+            identifier_column_callback()
+            continue
+        if field not in possible_fields:
+            unrecognized_column_callback(field)
+            continue
+        columns.append((index, field, compile_normalizer(possible_fields[field])))
+
+    def iter_rows():
+        with in_file:
+            for row in reader:
+                #skip empty rows
+                if len(row) == 0:
+                    continue
+
+                patient = {}
+
+                for index, field, normalize in columns:
+                    if index >= len(row):
+                        break
+                    value = row[index]
+                    if value == '':
+                        continue
+                    normalized_value = normalize(value)
+                    if normalized_value == None:
+                        unrecognized_value_callback(value, field)
+                    else:
+                        patient[field] = normalized_value
+
+                yield patient
+
+    return iter_rows()
+
+def parse_csv_file(bot, file_name, unrecognized_column_callback, unrecognized_value_callback,
+                   identifier_column_callback):
+    return list(iter_csv_file(
+        bot,
+        file_name,
+        unrecognized_column_callback,
+        unrecognized_value_callback,
+        identifier_column_callback
+    ))
+
+def get_patient_ids(bot, patients, progress_callback, max_workers=PhenoTipsBot.MAX_WORKERS, cancel_event=None):
+    patient_ids = {}
+    count = 0
+
+    for patient_id, patient in resolve_patient_ids(bot, patients, max_workers, cancel_event):
+        external_id = patient.get('external_id')
+        if external_id:
+            if patient_id:
+                patient_ids[external_id] = patient_id
+            count += 1
+            progress_callback(count)
+
+    return patient_ids
+
+def count_results(results, progress_callback):
+    count = 0
+    n_created = 0
+    n_changed = 0
+    n_unchanged = 0
+
+    for patient_id, result in results:
+        if result == 'created':
+            n_created += 1
+        elif result == 'changed':
+            n_changed += 1
+        else:
+            n_unchanged += 1
+        count += 1
+        progress_callback(count)
+
+    return n_created, n_changed, n_unchanged
+
+def import_patients(bot, patients, patient_ids, study, owner, progress_callback, max_workers=PhenoTipsBot.MAX_WORKERS, cancel_event=None):
+    start_time = time.time()
+
+    resolved_patients = ((patient_ids.get(patient.get('external_id')), patient) for patient in patients)
+    results = save_patients(bot, resolved_patients, study, owner, max_workers, cancel_event)
+    n_created, n_changed, n_unchanged = count_results(results, progress_callback)
+
+    return n_created, n_changed, n_unchanged, timedelta(seconds=time.time() - start_time)
+
+def stream_import_patients(bot, patients, study, owner, progress_callback, max_workers=PhenoTipsBot.MAX_WORKERS, cancel_event=None):
+    start_time = time.time()
+
+    #look up the external IDs of the next rows and upload the previous ones while the file is still being read
+    resolved_patients = resolve_patient_ids(bot, patients, max_workers, cancel_event)
+    results = save_patients(bot, resolved_patients, study, owner, max_workers, cancel_event)
+    n_created, n_changed, n_unchanged = count_results(results, progress_callback)
+
+    return n_created, n_changed, n_unchanged, timedelta(seconds=time.time() - start_time)
+
+def compile_converter(prop):
+    #turn the strings that the server returns into the native type of the property
+    if prop['type'] == 'Number':
+        if prop.get('numberType') in ('integer', 'long'):
+            convert = int
+        else:
+            convert = float
+    elif prop['type'] == 'Date':
+        convert = parse_date
+    elif prop['type'] == 'Boolean':
+        convert = lambda value: value == '1'
+    else:
+        return lambda value: value
+
+    def convert_or_none(value):
+        if not value:
+            return None
+        try:
+            return convert(value)
+        except ValueError:
+            return None
+
+    return convert_or_none
+
+def arrow_type(prop):
+    import pyarrow
+    if prop['type'] == 'Number':
+        if prop.get('numberType') in ('integer', 'long'):
+            return pyarrow.int64()
+        else:
+            return pyarrow.float64()
+    elif prop['type'] == 'Date':
+        return pyarrow.date32()
+    elif prop['type'] == 'Boolean':
+        return pyarrow.bool_()
+    else:
+        return pyarrow.string()
+
+def export_patients(bot, patient_ids, out_file, progress_callback, out_format='csv', row_group_size=10000,
+                    max_workers=PhenoTipsBot.MAX_WORKERS, cancel_event=None):
+    start_time = time.time()
+    count = 0
+    n_exported = 0
+
+    props = bot.list_patient_class_properties()
+    prop_names = list(props)
+
+    if out_format == 'csv':
+        writer = csv.writer(out_file)
+        writer.writerow(prop_names)
+        write_rows = writer.writerows
+        close = lambda: None
+    elif out_format == 'ndjson':
+        converters = [compile_converter(props[prop_name]) for prop_name in prop_names]
+        def write_rows(rows):
+            for row in rows:
+                record = {prop_name: convert(value) for prop_name, convert, value in zip(prop_names, converters, row)}
+                out_file.write(json.dumps(record, default=date.isoformat) + '\n')
+        close = lambda: None
+    elif out_format == 'parquet':
+        import pyarrow
+        import pyarrow.parquet
+        converters = [compile_converter(props[prop_name]) for prop_name in prop_names]
+        schema = pyarrow.schema([(prop_name, arrow_type(props[prop_name])) for prop_name in prop_names])
+        writer = pyarrow.parquet.ParquetWriter(out_file, schema)
+        def write_rows(rows):
+            columns = [[convert(row[i]) for row in rows] for i, convert in enumerate(converters)]
+            writer.write_table(pyarrow.Table.from_arrays(columns, schema=schema))
+        close = writer.close
+    else:
+        raise ValueError('Unknown export format "' + out_format + '"')
+
+    #write in blocks so that memory stays bounded and each Parquet row group is a useful size
+    rows = []
+    for patient_id, patient in fetch_patients(bot, patient_ids, max_workers=max_workers, cancel_event=cancel_event):
+        progress_callback(count)
+        count += 1
+
+        row = []
+        for prop_name in prop_names:
+            row.append(patient.get(prop_name))
+        rows.append(row)
+        n_exported += 1
+
+        if len(rows) >= row_group_size:
+            write_rows(rows)
+            rows = []
+
+    if rows:
+        write_rows(rows)
+    close()
+
+    return n_exported, timedelta(seconds=time.time() - start_time)
+
+def get_clinvar_data(bot, patient_ids, gene, progress_callback, cancel_event=None, variants=None, patient_keys=None):
+    start_time = time.time()
+    count = 0
+
+    clinvar_data = OrderedDict()
+
+    for patient_id in patient_ids:
+        if cancel_event and cancel_event.is_set():
+            break
+        count += 1
+        progress_callback(count)
+
+        #reuse the variants that were already downloaded to build the gene index
+        if variants is not None and patient_id in variants:
+            clinvar_variant_objs = variants[patient_id]
+        else:
+            clinvar_variant_objs = get_clinvar_variants(bot, patient_id)
+        #remember which aggregate rows each patient is part of, so that an incremental export can count them again
+        if patient_keys is not None:
+            patient_keys[patient_id] = []
+        if len(clinvar_variant_objs) == 0:
+            continue
+
+        #every variant keeps a reference to its patient, so store them compactly
+        patient_obj = bot.get(patient_id, compact=True)
+
+        for clinvar_variant_obj in clinvar_variant_objs:
+            gene_symbol = clinvar_variant_obj.get('gene_symbol')
+
+            if gene and (not gene_symbol or not gene in map(str.strip, gene_symbol.upper().split(';'))):
+                continue
+
+            #we aggregate all fields except for these
+            clinvar_data_key = (
+                clinvar_variant_obj['reference_sequence']    if 'reference_sequence'    in clinvar_variant_obj else None,
+                clinvar_variant_obj['hgvs']                  if 'hgvs'                  in clinvar_variant_obj else None,
+                clinvar_variant_obj['cis_or_trans']          if 'cis_or_trans'          in clinvar_variant_obj else None,
+                clinvar_variant_obj['location']              if 'location'              in clinvar_variant_obj else None,
+                patient_obj['omim_id']                       if 'omim_id'               in patient_obj         else None,
+                clinvar_variant_obj['condition_category']    if 'condition_category'    in clinvar_variant_obj else None,
+                clinvar_variant_obj['clinical_significance'] if 'clinical_significance' in clinvar_variant_obj else None,
+                clinvar_variant_obj['collection_method']     if 'collection_method'     in clinvar_variant_obj else None,
+                clinvar_variant_obj['allele_origin']         if 'allele_origin'         in clinvar_variant_obj else None,
+                clinvar_variant_obj['tissue']                if 'tissue'                in clinvar_variant_obj else None,
+                patient_obj        ['case_or_control']       if 'case_or_control'       in patient_obj         else None,
+            )
+
+            if not clinvar_data_key in clinvar_data:
+                clinvar_data[clinvar_data_key] = []
+
+            clinvar_data[clinvar_data_key].append((patient_obj, clinvar_variant_obj))
+            if patient_keys is not None and not clinvar_data_key in patient_keys[patient_id]:
+                patient_keys[patient_id].append(clinvar_data_key)
+
+    return clinvar_data, timedelta(seconds=time.time() - start_time)
+
+def get_clinvar_variants(bot, patient_id):
+    return [
+        bot.get_object(patient_id, 'PhenoTips.ClinVarVariantClass', clinvar_variant_num, compact=True)
+        for clinvar_variant_num in bot.list_objects(patient_id, 'PhenoTips.ClinVarVariantClass')
+    ]
+
+def get_clinvar_genes(clinvar_variant_objs):
+    #a gene symbol can name several genes, such as "BRCA1; TP53"
+    genes = set()
+    for clinvar_variant_obj in clinvar_variant_objs:
+        gene_symbol = clinvar_variant_obj.get('gene_symbol')
+        if gene_symbol:
+            genes.update(gene.strip() for gene in gene_symbol.upper().split(';'))
+    genes.discard('')
+    return sorted(genes)
+
+def get_clinvar_index_path(bot):
+    #the index is kept with the class caches, separately for each user because users can see different patients
+    if not bot.cache_dir:
+        return None
+    index_dir = join(bot.cache_dir, hashlib.sha1(bot.base.encode('utf-8')).hexdigest())
+    try:
+        os.makedirs(index_dir, exist_ok=True)
+    except OSError:
+        return None
+    return join(index_dir, 'ClinVarIndex-' + hashlib.sha1(bot.auth[0].encode('utf-8')).hexdigest() + '.json')
+
+def index_clinvar_variants(bot, patient_ids, progress_callback, max_workers=PhenoTipsBot.MAX_WORKERS, cancel_event=None,
+                           patient_genes=None):
+    #patient_genes can hold the genes of patients indexed before, which are kept unless the patient is in patient_ids
+    count = 0
+
+    patient_genes = patient_genes if patient_genes is not None else {}
+    variants = {}
+
+    def get_variants(patient_id):
+        return patient_id, get_clinvar_variants(bot, patient_id)
+
+    #the query API can only return page names, so the variants have to be downloaded to see their genes
+    for patient_id, clinvar_variant_objs in map_concurrently(get_variants, patient_ids, max_workers, cancel_event):
+        count += 1
+        progress_callback(count)
+        variants[patient_id] = clinvar_variant_objs
+        patient_genes[patient_id] = get_clinvar_genes(clinvar_variant_objs)
+
+    gene_table = OrderedDict()
+    for patient_id, genes in patient_genes.items():
+        for gene in genes:
+            gene_table.setdefault(gene, set()).add(patient_id)
+
+    return gene_table, variants
+
+def recount_clinvar_data(bot, clinvar_data_keys, study, owner, gene, progress_callback, patient_keys=None):
+    #each row of Variant.csv counts every case of its variant, so collect the cases of the given variants from every
+    #patient instead of only the ones that changed; variants without any cases left get an empty list
+    where = [('PhenoTips.ClinVarVariantClass', 'gene_symbol', 'contains', gene)] if gene else []
+    hgvs_values = set(key[1] for key in clinvar_data_keys)
+    if None in hgvs_values:
+        patient_ids = bot.list(study, owner, having_object='PhenoTips.ClinVarVariantClass', where=where)
+    else:
+        #only patients with a variant of the same HGVS can share an aggregate row, and a hundred values at a time keep
+        #the query URL short
+        hgvs_values = sorted(hgvs_values)
+        patient_ids = OrderedDict()
+        for i in range(0, len(hgvs_values), 100):
+            hgvs_where = [('PhenoTips.ClinVarVariantClass', 'hgvs', 'in', hgvs_values[i:i+100])]
+            patient_ids.update(OrderedDict.fromkeys(
+                bot.list(study, owner, having_object='PhenoTips.ClinVarVariantClass', where=where + hgvs_where)
+            ))
+
+    clinvar_data, elapsed_time = get_clinvar_data(bot, patient_ids, gene, progress_callback, patient_keys=patient_keys)
+
+    recounted_data = OrderedDict(
+        (clinvar_data_key, clinvar_data_values) for clinvar_data_key, clinvar_data_values in clinvar_data.items()
+        if clinvar_data_key in clinvar_data_keys
+    )
+    for clinvar_data_key in clinvar_data_keys:
+        recounted_data.setdefault(clinvar_data_key, [])
+    return recounted_data, elapsed_time
+
+def write_clinvar_files(clinvar_data, variant_file, case_data_file):
+    start_time = time.time()
+
+    linking_id = 0
+    case_count = 0
+    max_methods = 0
+
+    aggregate_data = []
+    case_data = []
+
+    for clinvar_data_key, clinvar_data_values in clinvar_data.items():
+        linking_id += 1
+        gene_symbols             = set()
+        reference_sequence       = clinvar_data_key[0]
+        hgvs                     = clinvar_data_key[1]
+        cis_or_trans             = clinvar_data_key[2]
+        variation_identifiers    = set()
+        location                 = clinvar_data_key[3]
+        alternate_designations   = set()
+        official_allele_name     = ''
+        url                      = ''
+        if clinvar_data_key[4]:
+            omim_ids             = clinvar_data_key[4].replace('|', ';')
+        else:
+            omim_ids             = ''
+        condition_category       = clinvar_data_key[5]
+        clinical_significance    = clinvar_data_key[6]
+        date_last_evaluated      = date.min
+        mode_of_inheritance      = set()
+        collection_method        = clinvar_data_key[7]
+        allele_origin            = clinvar_data_key[8]
+        clinical_features        = set()
+        tissue                   = clinvar_data_key[9]
+        if clinvar_data_key[10] == 'case':
+            affected_status      = 'yes'
+        elif clinvar_data_key[10] == 'control':
+            affected_status      = 'no'
+        else:
+            affected_status      = 'unknown'
+        individuals_with_variant = 0
+        chromosomes_with_variant = 0
+        mosaicism                = 0
+        homozygotes              = 0
+        single_heterozygotes     = 0
+        compound_heterozygotes   = 0
+        hemizygotes              = 0
+        methods                  = set()
+
+        for patient_obj, clinvar_variant_obj in clinvar_data_values:
+            patient_external_id = ''
+            patient_clinical_features = []
+            patient_sex = ''
+            patient_cosanguinity = ''
+            patient_condition_comment = ''
+            patient_is_proband = ''
+            patient_kindred_id = ''
+            patient_mosaicism = ''
+            patient_zygosity = ''
+            variant_method = ('', '')
+
+            if patient_obj.get('external_id'):
+                patient_external_id = patient_obj['external_id']
+            if clinvar_variant_obj.get('gene_symbol'):
+                gene_symbols |= set(clinvar_variant_obj['gene_symbol'].split(';'))
+            if clinvar_variant_obj.get('variation_identifiers'):
+                variation_identifiers |= set(clinvar_variant_obj['variation_identifiers'].split(';'))
+            if clinvar_variant_obj.get('alternate_designations'):
+                alternate_designations |= set(clinvar_variant_obj['alternate_designations'].split('|'))
+            if clinvar_variant_obj.get('official_allele_name') and not official_allele_name:
+                official_allele_name = clinvar_variant_obj['official_allele_name']
+            if clinvar_variant_obj.get('url') and not url:
+                url = clinvar_variant_obj['url']
+            try:
+                variant_date_last_evaluated = parse_date(clinvar_variant_obj['date_last_evaluated'])
+                if variant_date_last_evaluated > date_last_evaluated:
+                    date_last_evaluated = variant_date_last_evaluated
+            except Exception:
+                pass
+            if patient_obj.get('global_mode_of_inheritance'):
+                for term in patient_obj['global_mode_of_inheritance']:
+                    if term == 'HP:0003745':
+                        mode_of_inheritance |= 'Sporadic'
+                    elif term == 'HP:0000006':
+                        mode_of_inheritance |= 'Autosomal dominant inheritance'
+                    elif term == 'HP:0001470':
+                        mode_of_inheritance |= 'Sex-limited autosomal dominant'
+                    elif term == 'HP:0001475':
+                        mode_of_inheritance |= 'Male-limited autosomal dominant'
+                    elif term == 'HP:0001444':
+                        mode_of_inheritance |= 'Autosomal dominant somatic cell mutation'
+                    elif term == 'HP:0001452':
+                        mode_of_inheritance |= 'Autosomal dominant contiguous gene syndrome'
+                    elif term == 'HP:0000007':
+                        mode_of_inheritance |= 'Autosomal recessive inheritance'
+                    elif term == 'HP:0010985':
+                        mode_of_inheritance |= 'Gonosomal inheritance'
+                    elif term == 'HP:0001417':
+                        mode_of_inheritance |= 'X-linked inheritance'
+                    elif term == 'HP:0001423':
+                        mode_of_inheritance |= 'X-linked dominant inheritance'
+                    elif term == 'HP:0001419':
+                        mode_of_inheritance |= 'X-linked recessive inheritance'
+                    elif term == 'HP:0001450':
+                        mode_of_inheritance |= 'Y-linked inheritance'
+                    elif term == 'HP:0001426':
+                        mode_of_inheritance |= 'Multifactorial inheritance'
+                    elif term == 'HP:0010984':
+                        mode_of_inheritance |= 'Digenic inheritance'
+                    elif term == 'HP:0010983':
+                        mode_of_inheritance |= 'Oligogenic inheritance'
+                    elif term == 'HP:0010982':
+                        mode_of_inheritance |= 'Polygenic inheritance'
+                    elif term == 'HP:0001427':
+                        mode_of_inheritance |= 'Mitochondrial inheritance'
+            if patient_obj.get('phenotype'):
+                patient_clinical_features = set(patient_obj['phenotype'].split('|'))
+                clinical_features |= patient_clinical_features
+            if patient_obj.get('gender'):
+                patient_sex = patient_obj['gender']
+            if clinvar_variant_obj.get('mosaicism') == 'yes':
+                mosaicism += 1
+                patient_mosaicism = 'yes'
+            elif clinvar_variant_obj.get('mosaicism') == 'no':
+                patient_mosaicism = 'no'
+            patient_zygosity = clinvar_variant_obj.get('zygosity')
+            if patient_zygosity == 'single heterozygote':
+                individuals_with_variant += 1
+                chromosomes_with_variant += 1
+                single_heterozygotes += 1
+            elif patient_zygosity == 'compound heterozygote':
+                individuals_with_variant += 1
+                chromosomes_with_variant += 1
+                compound_heterozygotes += 1
+            elif patient_zygosity == 'homozygote':
+                individuals_with_variant += 1
+                chromosomes_with_variant += 2
+                homozygotes += 1
+            elif patient_zygosity == 'hemizygote':
+                individuals_with_variant += 1
+                chromosomes_with_variant += 1
+                hemizygotes += 1
+            if patient_obj.get('consanguinity') == 0:
+                patient_consanguinity = 'no'
+            elif patient_obj.get('consanguinity') == 1:
+                patient_cosanguinity = 'yes'
+            if patient_obj.get('diagnosis_notes'):
+                patient_condition_comment = patient_obj['diagnosis_notes']
+            if patient_obj.get('subject_data_relationship'):
+                if patient_obj['subject_data_relationship'].lower() == 'proband':
+                    patient_is_proband = 'yes'
+                else:
+                    patient_is_proband = 'no'
+            if patient_obj.get('kindred_id'):
+                patient_kindred_id = patient_obj['kindred_id']
+            if clinvar_variant_obj.get('test_name_or_type') or clinvar_variant_obj.get('platform_type'):
+                variant_method = (clinvar_variant_obj.get('test_name_or_type', ''), clinvar_variant_obj.get('platform_type', ''))
+                methods.add(variant_method)
+
+            case_data.append([
+                linking_id,
+                patient_external_id,
+                collection_method,
+                allele_origin,
+                affected_status,
+                '',
+                ';'.join(sorted(patient_clinical_features)),
+                tissue,
+                patient_sex,
+                '',
+                '',
+                '',
+                '',
+                patient_cosanguinity,
+                patient_condition_comment,
+                '',
+                patient_is_proband,
+                patient_kindred_id,
+                '',
+                '',
+                patient_mosaicism,
+                patient_zygosity,
+                '',
+                '',
+                '',
+                '',
+                '',
+                '',
+                variant_method[0],
+                variant_method[1],
+            ])
+
+            case_count += 1
+
+        row = [
+            '',
+            linking_id,
+            ';'.join(sorted(gene_symbols)),
+            reference_sequence,
+            hgvs,
+            '',
+            '',
+            '',
+            '',
+            '',
+            '',
+            '',
+            '',
+            '',
+            '',
+            '',
+            '',
+            '',
+            '',
+            '',
+            '',
+            '',
+            cis_or_trans,
+            ';'.join(sorted(variation_identifiers)),
+            location,
+            '|'.join(sorted(alternate_designations)),
+            official_allele_name,
+            url,
+            '',
+            'OMIM',
+            omim_ids,
+            '',
+            condition_category,
+            '',
+            '',
+            clinical_significance,
+            date_last_evaluated.isoformat(),
+            '',
+            '',
+            ';'.join(sorted(mode_of_inheritance)),
+            '',
+            '',
+            '',
+            '',
+            '',
+            '',
+            '',
+            '',
+            collection_method,
+            allele_origin,
+            affected_status,
+            '',
+            ';'.join(sorted(clinical_features)),
+            '',
+            '',
+            '',
+            '',
+            '',
+            '',
+            '',
+            len(clinvar_data_values),
+            '',
+            '',
+            individuals_with_variant,
+            chromosomes_with_variant,
+            '',
+            '',
+            mosaicism,
+            homozygotes,
+            single_heterozygotes,
+            compound_heterozygotes,
+            hemizygotes,
+            '',
+            '',
+            '',
+            '',
+        ]
+
+        for test_name_or_type, platform_type in sorted(methods):
+            row.append(test_name_or_type)
+            row.append(platform_type)
+            row.append('')
+            row.append('')
+            row.append('')
+            row.append('')
+            row.append('')
+            row.append('')
+            row.append('')
+            row.append('')
+
+        aggregate_data.append(row);
+
+        if len(methods) > max_methods:
+            max_methods = len(methods)
+
+    aggregate_columns = [
+        '##Local ID',
+        'Linking ID',
+        'Gene symbol',
+        'Reference sequence',
+        'HGVS',
+        'Chromosome',
+        'Start',
+        'Stop',
+        'Reference allele',
+        'Alternate allele',
+        'Variant type',
+        'Outer start',
+        'Inner start',
+        'Inner stop',
+        'Outer stop',
+        'Variant length',
+        'Copy number',
+        'Reference copy number',
+        'Breakpoint 1',
+        'Breakpoint 2',
+        'Trace or probe data',
+        '',
+        'Cis or trans',
+        'Variation identifiers',
+        'Location',
+        'Alternate designations',
+        'Official allele name',
+        'URL',
+        '',
+        'Condition ID type',
+        'Condition ID value',
+        'Preferred condition name',
+        'Condition category',
+        'Condition uncertainty',
+        'Condition comment',
+        'Clinical significance',
+        'Date last evaluated',
+        'Assertion method',
+        'Assertion method citation',
+        'Mode of inheritance',
+        'Clinical significance citations',
+        'Citations or URLs for clinical significance without database identifiers',
+        'Comment on clinical significance',
+        'Explanation if clinical significance is other or drug response',
+        'Drug response condition',
+        'Functional consequence',
+        'Comment on functional consequence',
+        '',
+        'Collection method',
+        'Allele origin',
+        'Affected status',
+        'Structural variant method/analysis type',
+        'Clinical features',
+        'Tissue',
+        'Sex',
+        'Age range',
+        'Population Group/Ethnicity',
+        'Geographic origin',
+        'Family history',
+        'Indication',
+        'Total number of individuals tested',
+        'Number of families tested',
+        '',
+        'Number of individuals with variant',
+        'Number of chromosomes with variant',
+        'Number of families with variant',
+        'Number of families with segregation observed',
+        'Mosaicism',
+        'Number of homozygotes',
+        'Number of single heterozygotes',
+        'Number of compound heterozygotes',
+        'Number of hemizygotes',
+        'Evidence citations',
+        'Citations or URLs that cannot be represented in evidence citations column',
+        'Comment on evidence',
+        '',
+        'Test name or type',
+        'Platform type',
+        'Platform name',
+        'Method',
+        'Method purpose',
+        'Method citations',
+        'Software name and version',
+        'Software purpose',
+        'Testing laboratory',
+        'Date variant was reported to submitter',
+        '',
+        'Comment',
+        'Private comment',
+        'ClinVarAccession',
+        'Novel or Update',
+        'Replaces ClinVarAccessions',
+    ]
+
+    for i in range(1, max_methods):
+        aggregate_columns.insert(76, 'Test name or type')
+        aggregate_columns.insert(77, 'Platform type')
+        aggregate_columns.insert(78, 'Platform name')
+        aggregate_columns.insert(79, 'Method')
+        aggregate_columns.insert(80, 'Method purpose')
+        aggregate_columns.insert(81, 'Method citations')
+        aggregate_columns.insert(82, 'Software name and version')
+        aggregate_columns.insert(83, 'Software purpose')
+        aggregate_columns.insert(84, 'Testing laboratory')
+        aggregate_columns.insert(85, 'Date variant was reported to submitter')
+
+    aggregate_data.insert(0, aggregate_columns)
+
+    case_data.insert(0, [
+        '##Linking ID',
+        'Individual ID',
+        'Collection method',
+        'Allele origin',
+        'Affected status',
+        'Structural variant method/analysis type',
+        'Clinical features',
+        'Tissue',
+        'Sex',
+        'Age',
+        'Population Group/Ethnicity',
+        'Geographic origin',
+        'Indication',
+        'Family history',
+        'Condition comment',
+        '',
+        'Proband',
+        'Family ID',
+        'Segregation observed',
+        'Secondary finding',
+        'Mosaicism',
+        'Zygosity',
+        'Co-occurrences, same gene',
+        'Co-occurrences, other genes',
+        'Evidence citations',
+        'Citations or URLs that cannot be represented in evidence citations column',
+        'Comment on evidence',
+        '',
+        'Test name or type',
+        'Platform type',
+        'Platform name',
+        'Method',
+        'Method purpose',
+        'Method citations',
+        'Software name and version',
+        'Software purpose',
+    ])
+
+    csv.writer(variant_file).writerows(aggregate_data)
+    csv.writer(case_data_file).writerows(case_data)
+
+    return linking_id, case_count, timedelta(seconds=time.time() - start_time)
@@ -20,9 +20,12 @@
 # USA
 
 import sys
+from collections import Counter
 from getopt import getopt
 from getpass import getpass
 from phenotipsbot import PhenoTipsBot
+from phenotipsbot import fetch_patients
+from phenotipsbot import map_concurrently
 from sys import stderr
 
 #parse arguments
@@ -70,42 +73,69 @@ if not password:
 
 bot = PhenoTipsBot(base_url, username, password)
 
-patient_ids = bot.list()
+#group patients by owner and study on the server, one query per owner or study instead of two requests per patient
 
-stderr.write('Looking through ' + str(len(patient_ids)) + ' patient records...\n')
+patient_ids = set(bot.list())
+directory = bot.list_directory()
+
+owners = directory['users'] + ['Groups.' + group for group in directory['groups']]
+patients_by_owner = dict(zip(owners, map_concurrently(lambda owner: set(bot.list(owner=owner)), owners)))
+patients_by_owner[''] = patient_ids.difference(*patients_by_owner.values())
+if len(wanted_users):
+    patients_by_owner = {owner: ids for owner, ids in patients_by_owner.items() if owner.lower() in wanted_users}
+
+studies = directory['studies']
+patients_by_study = dict(zip(studies, map_concurrently(lambda study: set(bot.list(study=study)), studies)))
+patients_by_study[''] = patient_ids.difference(*patients_by_study.values())
+if len(wanted_studies):
+    patients_by_study = {study: ids for study, ids in patients_by_study.items() if study.lower() in wanted_studies}
+
+wanted_patient_ids = patient_ids.intersection(
+    set().union(*patients_by_owner.values()),
+    set().union(*patients_by_study.values())
+)
+
+stderr.write('Looking through ' + str(len(wanted_patient_ids)) + ' of ' + str(len(patient_ids)) + ' patient records...\n')
 stderr.write('\n')
 
+#only download the patients that passed the filters, several at a time
+
 count = 0
-patient_total = 0
+patient_total = len(wanted_patient_ids)
 positive_phenotype_total = 0
 negative_phenotype_total = 0
-owners = set()
-studies = set()
+positive_phenotype_histogram = Counter()
 fields_used = set()
-for patient_id in patient_ids:
+for patient_id, patient in fetch_patients(bot, sorted(wanted_patient_ids)):
     stderr.write(str(count) + '\r')
     count += 1
 
-    owner = bot.get_owner(patient_id) or ''
-    study = bot.get_study(patient_id) or ''
-    if ((len(wanted_users) == 0 or owner.lower() in wanted_users) and
-            (len(wanted_studies) == 0 or study.lower() in wanted_studies)):
-        patient_total += 1
-        owners.add(owner)
-        studies.add(study)
-        patient = bot.get(patient_id)
-        if patient['phenotype']:
-            positive_phenotype_total += len(patient['phenotype'].split('|'))
-        if patient['negative_phenotype']:
-            negative_phenotype_total += len(patient['negative_phenotype'].split('|'))
-        for key, value in patient.items():
-            if value:
-                #print(key + ': ' + value)
-                fields_used.add(key)
+    n_positive_phenotypes = len(patient['phenotype'].split('|')) if patient.get('phenotype') else 0
+    positive_phenotype_total += n_positive_phenotypes
+    positive_phenotype_histogram[n_positive_phenotypes] += 1
+    if patient.get('negative_phenotype'):
+        negative_phenotype_total += len(patient['negative_phenotype'].split('|'))
+    for key, value in patient.items():
+        if value:
+            #print(key + ': ' + value)
+            fields_used.add(key)
+
+owner_counts = {}
+for owner, owner_patient_ids in patients_by_owner.items():
+    if len(owner_patient_ids & wanted_patient_ids):
+        owner_counts[owner] = len(owner_patient_ids & wanted_patient_ids)
+study_counts = {}
+for study, study_patient_ids in patients_by_study.items():
+    if len(study_patient_ids & wanted_patient_ids):
+        study_counts[study] = len(study_patient_ids & wanted_patient_ids)
 
 print('Owned patients: ' + str(patient_total))
-print('Average positive phenotypes per patient: ' + str(positive_phenotype_total / patient_total))
-print('Average negative phenotypes per patient: ' + str(negative_phenotype_total / patient_total))
-print('Owners: ' + str(len(owners)) + ', ' + str(sorted(owners)))
-print('Study forms: ' + str(len(studies)) + ', ' + str(sorted(studies)))
+if patient_total:
+    print('Average positive phenotypes per patient: ' + str(positive_phenotype_total / patient_total))
+    print('Average negative phenotypes per patient: ' + str(negative_phenotype_total / patient_total))
+print('Owners: ' + str(len(owner_counts)) + ', ' + str(sorted(owner_counts)))
+print('Study forms: ' + str(len(study_counts)) + ', ' + str(sorted(study_counts)))
 print('Fields used at least once: ' + str(len(fields_used)) + ', ' + str(sorted(fields_used)))
+print('Patients per owner: ' + str(sorted(owner_counts.items())))
+print('Patients per study form: ' + str(sorted(study_counts.items())))
+print('Positive phenotypes per patient histogram: ' + str(sorted(positive_phenotype_histogram.items())))
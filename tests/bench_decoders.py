@@ -0,0 +1,60 @@
+# Benchmark of decoding PhenoTips REST responses as JSON and as XML
+#
+# Copyright 2016 University of Utah
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301
+# USA
+
+#run with python tests/bench_decoders.py; it only measures CPU time, the responses never leave the process
+
+import sys
+import time
+from os.path import abspath
+from os.path import dirname
+from xml.sax.saxutils import quoteattr
+from xml.sax.saxutils import escape
+
+sys.path.insert(0, dirname(abspath(__file__)))
+from test_decoders import fake_bot
+
+N_PROPERTIES = 200 #about as many as a patient record has
+N_CALLS = 2000
+
+def object_payload(n_properties):
+    props = [('prop' + str(i), 'value ' + str(i) if i % 4 else '') for i in range(n_properties)]
+    data = {'properties': [{'name': name, 'value': value} for name, value in props]}
+    xml = '<object xmlns="http://www.xwiki.org">' + ''.join(
+        '<property name=' + quoteattr(name) + '><value>' + escape(value) + '</value></property>' for name, value in props
+    ) + '</object>'
+    return {'/objects/PhenoTips.PatientClass/0': (data, xml)}
+
+def cpu_time_per_call(bot, compact):
+    start_time = time.process_time()
+    for i in range(N_CALLS):
+        bot.get('P0000001', compact)
+    return (time.process_time() - start_time) / N_CALLS
+
+if __name__ == '__main__':
+    payloads = object_payload(N_PROPERTIES)
+    print('Decoding a ' + str(N_PROPERTIES) + '-property object ' + str(N_CALLS) + ' times')
+    for compact in (False, True):
+        json_time = cpu_time_per_call(fake_bot(payloads, True), compact)
+        xml_time = cpu_time_per_call(fake_bot(payloads, False), compact)
+        print(
+            ('compact' if compact else 'dict   ') +
+            '  JSON ' + format(json_time * 1000, '.3f') + ' ms' +
+            '  XML ' + format(xml_time * 1000, '.3f') + ' ms' +
+            '  XML/JSON ' + format(xml_time / json_time, '.1f') + 'x'
+        )
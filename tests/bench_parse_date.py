@@ -0,0 +1,70 @@
+# Benchmark of parsing the dates in a large spreadsheet
+#
+# Copyright 2016 University of Utah
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301
+# USA
+
+#run with python tests/bench_parse_date.py; dateutil is only timed if it is installed
+
+import csv
+import importlib.util
+import random
+import sys
+import time
+from datetime import date
+from datetime import timedelta
+from os.path import abspath
+from os.path import dirname
+from os.path import join
+from tempfile import TemporaryDirectory
+
+sys.path.insert(0, dirname(dirname(abspath(__file__))))
+from phenotipsbot import parse_date
+
+N_ROWS = 100000
+
+def write_dates(file_name, n_rows):
+    #mostly ISO dates from a few years, with some US ones, the way a real spreadsheet repeats the same dates
+    random.seed(0)
+    with open(file_name, 'w', newline='') as out_file:
+        writer = csv.writer(out_file)
+        writer.writerow(['external_id', 'date_of_birth'])
+        for i in range(n_rows):
+            day = date(2010, 1, 1) + timedelta(days=random.randrange(2000))
+            date_str = day.strftime('%m/%d/%Y') if i % 10 == 0 else day.isoformat()
+            writer.writerow(['P' + str(i), date_str])
+
+def time_parser(file_name, parser):
+    start_time = time.process_time()
+    with open(file_name, newline='') as in_file:
+        reader = csv.reader(in_file)
+        next(reader)
+        for external_id, date_str in reader:
+            parser(date_str)
+    return time.process_time() - start_time
+
+if __name__ == '__main__':
+    with TemporaryDirectory() as temp_dir:
+        file_name = join(temp_dir, 'dates.csv')
+        write_dates(file_name, N_ROWS)
+        print('Parsing ' + str(N_ROWS) + ' dates')
+        parsers = [('parse_date', parse_date), ('parse_date without the cache', parse_date.__wrapped__)]
+        if importlib.util.find_spec('dateutil'):
+            from dateutil.parser import parse as parsedate
+            parsers.append(('dateutil', lambda date_str: parsedate(date_str).date()))
+        for name, parser in parsers:
+            parse_date.cache_clear()
+            print(format(time_parser(file_name, parser), '.3f') + ' s  ' + name)
@@ -0,0 +1,48 @@
+# Benchmark of the memory that patients take as Records and as dictionaries
+#
+# Copyright 2016 University of Utah
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301
+# USA
+
+#run with python tests/bench_record.py
+
+import sys
+import tracemalloc
+from os.path import abspath
+from os.path import dirname
+
+sys.path.insert(0, dirname(abspath(__file__)))
+from bench_decoders import object_payload
+from test_decoders import fake_bot
+
+N_PATIENTS = 10000
+N_PROPERTIES = 200
+
+def memory_used(compact):
+    #keeps every patient the way export-clinvar does and returns the bytes still allocated afterwards
+    bot = fake_bot(object_payload(N_PROPERTIES), True)
+    tracemalloc.start()
+    patients = [bot.get('P' + str(i).zfill(7), compact) for i in range(N_PATIENTS)]
+    size, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return size
+
+if __name__ == '__main__':
+    print('Keeping ' + str(N_PATIENTS) + ' patients of ' + str(N_PROPERTIES) + ' properties each')
+    dict_size = memory_used(False)
+    record_size = memory_used(True)
+    print(format(dict_size / 1000000, '.1f') + ' MB  dict')
+    print(format(record_size / 1000000, '.1f') + ' MB  Record')
@@ -0,0 +1,99 @@
+# Tests for the ClinVar export functions of PhenoTipsBot
+#
+# Copyright 2016 University of Utah
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301
+# USA
+
+import sys
+import unittest
+from os.path import abspath
+from os.path import dirname
+
+sys.path.insert(0, dirname(dirname(abspath(__file__))))
+from phenotipsbot import get_clinvar_genes
+from phenotipsbot import index_clinvar_variants
+from phenotipsbot import recount_clinvar_data
+
+class FakeBot:
+    #answers list(), list_objects(), get_object() and get() from a dictionary of patient_id: (patient_obj, variants)
+    def __init__(self, patients):
+        self.patients = patients
+
+    def list(self, study=None, owner=None, having_object=None, since=None, where=None):
+        patient_ids = list(self.patients)
+        for class_name, prop_name, operator, value in where or []:
+            patient_ids = [
+                patient_id for patient_id in patient_ids
+                if any(variant.get(prop_name) in value for variant in self.patients[patient_id][1])
+            ]
+        return patient_ids
+
+    def list_objects(self, patient_id, object_class):
+        return [str(i) for i in range(len(self.patients[patient_id][1]))]
+
+    def get_object(self, patient_id, object_class, object_num, compact=False):
+        return self.patients[patient_id][1][int(object_num)]
+
+    def get(self, patient_id, compact=False):
+        return self.patients[patient_id][0]
+
+def clinvar_data_key(hgvs):
+    return (None, hgvs, None, None, None, None, None, None, None, None, None)
+
+class RecountClinVarDataTest(unittest.TestCase):
+    def test_narrows_by_hgvs(self):
+        bot = FakeBot({
+            'P1': ({}, [{'hgvs': 'c.1A>G'}]),
+            'P2': ({}, [{'hgvs': 'c.1A>G'}]),
+            'P3': ({}, [{'hgvs': 'c.9T>C'}]),
+        })
+        clinvar_data, elapsed_time = recount_clinvar_data(
+            bot, {clinvar_data_key('c.1A>G'), clinvar_data_key('c.2del')}, None, None, None, lambda count: None
+        )
+        self.assertEqual(len(clinvar_data[clinvar_data_key('c.1A>G')]), 2)
+        self.assertEqual(clinvar_data[clinvar_data_key('c.2del')], [])
+        self.assertNotIn(clinvar_data_key('c.9T>C'), clinvar_data)
+
+    def test_empty_hgvs_among_others(self):
+        bot = FakeBot({
+            'P1': ({}, [{'hgvs': 'c.1A>G'}]),
+            'P2': ({}, [{'hgvs': None}]),
+        })
+        clinvar_data, elapsed_time = recount_clinvar_data(
+            bot, {clinvar_data_key('c.1A>G'), clinvar_data_key(None)}, None, None, None, lambda count: None
+        )
+        self.assertEqual(len(clinvar_data[clinvar_data_key('c.1A>G')]), 1)
+        self.assertEqual(len(clinvar_data[clinvar_data_key(None)]), 1)
+
+class IndexClinVarVariantsTest(unittest.TestCase):
+    def test_genes(self):
+        clinvar_variant_objs = [{'gene_symbol': 'brca1; TP53'}, {'gene_symbol': None}, {'gene_symbol': 'TP53;'}]
+        self.assertEqual(get_clinvar_genes(clinvar_variant_objs), ['BRCA1', 'TP53'])
+
+    def test_only_changed_patients_downloaded(self):
+        bot = FakeBot({
+            'P1': ({}, [{'gene_symbol': 'ACADM'}]),
+            'P2': ({}, [{'gene_symbol': 'BRCA1; TP53'}]),
+        })
+        #P1 was indexed before with another gene and P3 no longer has variants, so the caller left it out
+        patient_genes = {'P1': ['CFTR'], 'P4': ['TP53']}
+        gene_table, variants = index_clinvar_variants(bot, ['P1', 'P2'], lambda count: None, patient_genes=patient_genes)
+        self.assertEqual(set(variants), {'P1', 'P2'})
+        self.assertEqual(patient_genes, {'P1': ['ACADM'], 'P2': ['BRCA1', 'TP53'], 'P4': ['TP53']})
+        self.assertEqual(gene_table, {'ACADM': {'P1'}, 'BRCA1': {'P2'}, 'TP53': {'P2', 'P4'}})
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,164 @@
+# Tests that PhenoTipsBot reads the same values from JSON and XML responses
+#
+# Copyright 2016 University of Utah
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301
+# USA
+
+import json
+import sys
+import unittest
+from os.path import abspath
+from os.path import dirname
+
+sys.path.insert(0, dirname(dirname(abspath(__file__))))
+from phenotipsbot import PhenoTipsBot
+
+#canned responses for each REST resource, the way PhenoTips sends them in each format
+PAYLOADS = {
+    '/objects/PhenoTips.PatientClass/0': (
+        {'properties': [
+            {'name': 'external_id', 'value': 'A1'},
+            {'name': 'gender', 'value': 'F'},
+            {'name': 'date_of_birth', 'value': ''},
+        ]},
+        '<object xmlns="http://www.xwiki.org">'
+        '<property name="external_id"><value>A1</value></property>'
+        '<property name="gender"><value>F</value></property>'
+        '<property name="date_of_birth"><value></value></property>'
+        '</object>'
+    ),
+    '/objects/PhenoTips.VCF': (
+        {'objectSummaries': [{'number': 0}, {'number': 2}]},
+        '<objects xmlns="http://www.xwiki.org">'
+        '<objectSummary><number>0</number></objectSummary>'
+        '<objectSummary><number>2</number></objectSummary>'
+        '</objects>'
+    ),
+    '/query': (
+        {'searchResults': [{'id': 'xwiki:data.P0000001'}, {'id': 'xwiki:data.P0000002'}]},
+        '<searchResults xmlns="http://www.xwiki.org">'
+        '<searchResult><id>xwiki:data.P0000001</id></searchResult>'
+        '<searchResult><id>xwiki:data.P0000002</id></searchResult>'
+        '</searchResults>'
+    ),
+    '/classes/PhenoTips.PatientClass': (
+        {'properties': [
+            {'name': 'gender', 'type': 'StaticList', 'attributes': [
+                {'name': 'values', 'value': 'M=Male|F=Female|U'},
+                {'name': 'multiSelect', 'value': '0'},
+            ]},
+            {'name': 'weight', 'type': 'Number', 'attributes': [{'name': 'numberType', 'value': 'float'}]},
+            {'name': 'external_id', 'type': 'String', 'attributes': [{'name': 'validationRegExp', 'value': r'\w+'}]},
+        ]},
+        '<class xmlns="http://www.xwiki.org">'
+        '<property name="gender" type="StaticList">'
+        '<attribute name="values" value="M=Male|F=Female|U"/><attribute name="multiSelect" value="0"/>'
+        '</property>'
+        '<property name="weight" type="Number"><attribute name="numberType" value="float"/></property>'
+        '<property name="external_id" type="String"><attribute name="validationRegExp" value="\\w+"/></property>'
+        '</class>'
+    ),
+    '/attachments': (
+        {'attachments': [{'name': 'a.vcf', 'size': 1234, 'version': '1.1'}, {'name': 'b.bam', 'size': 5, 'version': '2.1'}]},
+        '<attachments xmlns="http://www.xwiki.org">'
+        '<attachment><name>a.vcf</name><size>1234</size><version>1.1</version></attachment>'
+        '<attachment><name>b.bam</name><size>5</size><version>2.1</version></attachment>'
+        '</attachments>'
+    ),
+    '/spaces/PhenoTips/pages/PatientClass': (
+        {'version': '3.1'},
+        '<page xmlns="http://www.xwiki.org"><version>3.1</version></page>'
+    ),
+}
+
+class FakeResponse:
+    def __init__(self, content_type, text):
+        self.status_code = 200
+        self.headers = {'content-type': content_type}
+        self.text = text
+
+    def json(self):
+        return json.loads(self.text)
+
+    def raise_for_status(self):
+        pass
+
+class FakeSession:
+    #answers every GET with the canned payload of the resource in one format
+    def __init__(self, payloads, use_json):
+        #encode the payloads up front so that a benchmark only times the decoding
+        if use_json:
+            self.responses = {
+                suffix: FakeResponse('application/json; charset=utf-8', json.dumps(data))
+                for suffix, (data, xml) in payloads.items()
+            }
+        else:
+            self.responses = {suffix: FakeResponse('application/xml', xml) for suffix, (data, xml) in payloads.items()}
+
+    def get(self, url, params=None, headers=None, auth=None, verify=None):
+        return next(response for suffix, response in self.responses.items() if url.endswith(suffix))
+
+def fake_bot(payloads, use_json):
+    bot = PhenoTipsBot('http://localhost:8080', 'Admin', 'admin')
+    bot.session = FakeSession(payloads, use_json)
+    return bot
+
+class DecoderParityTest(unittest.TestCase):
+    def assertSameResult(self, call):
+        json_result = call(fake_bot(PAYLOADS, True))
+        xml_result = call(fake_bot(PAYLOADS, False))
+        self.assertEqual(json_result, xml_result)
+        return json_result
+
+    def test_parse_response(self):
+        data, root = PhenoTipsBot.parse_response(FakeResponse('application/json; charset=utf-8', '{"version": "3.1"}'))
+        self.assertEqual((data, root), ({'version': '3.1'}, None))
+        data, root = PhenoTipsBot.parse_response(FakeResponse('application/xml', PAYLOADS['/spaces/PhenoTips/pages/PatientClass'][1]))
+        self.assertIsNone(data)
+        self.assertEqual(root.find('{http://www.xwiki.org}version').text, '3.1')
+
+    def test_get_object(self):
+        result = self.assertSameResult(lambda bot: bot.get('P0000001'))
+        self.assertEqual(result, {'external_id': 'A1', 'gender': 'F', 'date_of_birth': None})
+        result = self.assertSameResult(lambda bot: tuple(bot.get('P0000001', compact=True).items()))
+        self.assertEqual(result, (('external_id', 'A1'), ('gender', 'F'), ('date_of_birth', None)))
+
+    def test_list_hql(self):
+        result = self.assertSameResult(lambda bot: bot.list_hql('where doc.space = :space', {'space': 'data'}))
+        self.assertEqual(result, ['xwiki:data.P0000001', 'xwiki:data.P0000002'])
+
+    def test_list_objects(self):
+        result = self.assertSameResult(lambda bot: bot.list_objects('P0000001', 'PhenoTips.VCF'))
+        self.assertEqual(result, ['0', '2'])
+
+    def test_download_class_properties(self):
+        result = self.assertSameResult(lambda bot: bot.download_class_properties('PhenoTips.PatientClass'))
+        self.assertEqual(result['gender'], {
+            'type': 'StaticList', 'multiSelect': False, 'values': {'M': 'Male', 'F': 'Female', 'U': 'U'}
+        })
+        self.assertEqual(result['weight'], {'type': 'Number', 'numberType': 'float'})
+        self.assertEqual(result['external_id'], {'type': 'String', 'validationRegExp': r'\w+'})
+
+    def test_list_files(self):
+        result = self.assertSameResult(lambda bot: bot.list_files('P0000001'))
+        self.assertEqual(dict(result), {'a.vcf': {'size': 1234, 'version': '1.1'}, 'b.bam': {'size': 5, 'version': '2.1'}})
+
+    def test_get_class_version(self):
+        result = self.assertSameResult(lambda bot: bot.get_class_version('PhenoTips.PatientClass'))
+        self.assertEqual(result, '3.1')
+
+if __name__ == '__main__':
+    unittest.main()
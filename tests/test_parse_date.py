@@ -0,0 +1,66 @@
+# Tests for the date parser of PhenoTipsBot
+#
+# Copyright 2016 University of Utah
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301
+# USA
+
+import importlib.util
+import sys
+import unittest
+from datetime import date
+from os.path import abspath
+from os.path import dirname
+from unittest import mock
+
+sys.path.insert(0, dirname(dirname(abspath(__file__))))
+from phenotipsbot import parse_date
+
+HAVE_DATEUTIL = importlib.util.find_spec('dateutil') != None
+
+class ParseDateTest(unittest.TestCase):
+    def setUp(self):
+        parse_date.cache_clear()
+
+    def test_fast_path(self):
+        #with dateutil hidden, importing it fails, so these can only be read by the regular expressions
+        with mock.patch.dict(sys.modules, {'dateutil': None, 'dateutil.parser': None}):
+            self.assertEqual(parse_date('2015-02-20'), date(2015, 2, 20))
+            self.assertEqual(parse_date('2015-2-3'), date(2015, 2, 3))
+            self.assertEqual(parse_date('2015-02-20 13:45'), date(2015, 2, 20))
+            self.assertEqual(parse_date('2015-02-20T13:45:30.123'), date(2015, 2, 20))
+            self.assertEqual(parse_date('02/20/2015'), date(2015, 2, 20))
+            self.assertEqual(parse_date('2/3/2015'), date(2015, 2, 3))
+
+    def test_fallback(self):
+        #dates that only look like the fast-path formats, or that aren't in them at all, are left to dateutil
+        with mock.patch.dict(sys.modules, {'dateutil': None, 'dateutil.parser': None}):
+            for date_str in ('20/02/2015', '2015-02-30', 'February 20, 2015'):
+                with self.subTest(date_str=date_str):
+                    self.assertRaises(ImportError, parse_date, date_str)
+
+    @unittest.skipUnless(HAVE_DATEUTIL, 'dateutil is not installed')
+    def test_day_first(self):
+        self.assertEqual(parse_date('20/02/2015'), date(2015, 2, 20))
+        self.assertEqual(parse_date('31/12/2015'), date(2015, 12, 31))
+        self.assertEqual(parse_date('February 20, 2015'), date(2015, 2, 20))
+
+    def test_cached(self):
+        parse_date('2015-02-20')
+        parse_date('2015-02-20')
+        self.assertEqual(parse_date.cache_info().hits, 1)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,76 @@
+# Tests for the import and export pipeline stages of PhenoTipsBot
+#
+# Copyright 2016 University of Utah
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301
+# USA
+
+import random
+import sys
+import time
+import unittest
+from os.path import abspath
+from os.path import dirname
+from threading import Lock
+
+sys.path.insert(0, dirname(dirname(abspath(__file__))))
+from phenotipsbot import save_patients
+
+class FakeBot:
+    #keeps the patients in a dictionary, taking a random moment to save each one so that concurrent saves overlap
+    def __init__(self, patients=None):
+        self.patients = dict(patients or {})
+        self.lock = Lock()
+
+    def create(self, patient_obj, study=None, owner=None):
+        time.sleep(random.random() / 100)
+        with self.lock:
+            patient_id = 'P' + str(len(self.patients) + 1).zfill(7)
+            self.patients[patient_id] = dict(patient_obj)
+        return patient_id
+
+    def update(self, patient_id, patient_obj):
+        time.sleep(random.random() / 100)
+        with self.lock:
+            changed = any(self.patients[patient_id].get(key) != value for key, value in patient_obj.items())
+            self.patients[patient_id].update(patient_obj)
+        return changed
+
+class SavePatientsTest(unittest.TestCase):
+    def test_same_patient_saved_in_order(self):
+        bot = FakeBot({'P0000001': {'external_id': 'A'}})
+        rows = [('P0000001', {'external_id': 'A', 'gender': str(i)}) for i in range(20)]
+        results = list(save_patients(bot, rows))
+        self.assertEqual(bot.patients['P0000001']['gender'], '19')
+        self.assertEqual(results, [('P0000001', 'changed')] * 20)
+
+    def test_same_new_patient_created_once(self):
+        bot = FakeBot()
+        rows = [(None, {'external_id': 'B', 'gender': str(i % 2)}) for i in range(10)]
+        results = list(save_patients(bot, rows))
+        self.assertEqual(len(bot.patients), 1)
+        self.assertEqual(results[0], ('P0000001', 'created'))
+        self.assertEqual(results[1:], [('P0000001', 'changed')] * 9)
+        self.assertEqual(bot.patients['P0000001']['gender'], '1')
+
+    def test_different_patients(self):
+        bot = FakeBot()
+        rows = [(None, {'external_id': str(i)}) for i in range(10)] + [(None, {'gender': 'M'}), (None, {'gender': 'M'})]
+        results = list(save_patients(bot, rows))
+        self.assertEqual(len(bot.patients), 12)
+        self.assertEqual([result for patient_id, result in results], ['created'] * 12)
+
+if __name__ == '__main__':
+    unittest.main()
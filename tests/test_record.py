@@ -0,0 +1,51 @@
+# Tests for the compact Record type of PhenoTipsBot
+#
+# Copyright 2016 University of Utah
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301
+# USA
+
+import sys
+import unittest
+from os.path import abspath
+from os.path import dirname
+
+sys.path.insert(0, dirname(dirname(abspath(__file__))))
+from phenotipsbot import Record
+from phenotipsbot import RecordSchema
+
+class RecordTest(unittest.TestCase):
+    def test_mapping(self):
+        record = Record(RecordSchema(['external_id', 'gender', 'phenotype']), ('A1', None, 'HP:0001|HP:0002'))
+        self.assertEqual(dict(record), {'external_id': 'A1', 'gender': None, 'phenotype': 'HP:0001|HP:0002'})
+        self.assertEqual(list(record), ['external_id', 'gender', 'phenotype'])
+        self.assertEqual(len(record), 3)
+        self.assertIn('gender', record)
+        self.assertNotIn('weight', record)
+        self.assertEqual(record.get('weight'), None)
+        self.assertRaises(KeyError, lambda: record['weight'])
+
+    def test_get_list(self):
+        record = Record(RecordSchema(['phenotype', 'genes']), ('HP:0001|HP:0002', None))
+        self.assertEqual(record.get_list('phenotype'), ['HP:0001', 'HP:0002'])
+        self.assertEqual(record.get_list('genes'), [])
+        self.assertEqual(record.get_list('weight'), [])
+
+    def test_no_instance_dict(self):
+        record = Record(RecordSchema(['external_id']), ('A1',))
+        self.assertFalse(hasattr(record, '__dict__'))
+
+if __name__ == '__main__':
+    unittest.main()
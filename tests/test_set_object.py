@@ -0,0 +1,67 @@
+# Tests for writing objects with PhenoTipsBot
+#
+# Copyright 2016 University of Utah
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301
+# USA
+
+import gzip
+import sys
+import unittest
+from os.path import abspath
+from os.path import dirname
+from urllib.parse import parse_qs
+
+sys.path.insert(0, dirname(dirname(abspath(__file__))))
+from phenotipsbot import PhenoTipsBot
+
+class FakeResponse:
+    def raise_for_status(self):
+        pass
+
+class FakeSession:
+    #remembers the headers and body of the last PUT
+    def put(self, url, headers=None, auth=None, data=None, verify=None):
+        self.headers = headers
+        self.data = data
+        return FakeResponse()
+
+def put_form(compress_uploads, patient_obj):
+    #returns the form that set_object sends as a dictionary, the way the server would read it
+    bot = PhenoTipsBot('http://localhost:8080', 'Admin', 'admin', compress_uploads=compress_uploads)
+    bot.session = FakeSession()
+    bot.set_object('P0000001', 'PhenoTips.PatientClass', '0', patient_obj)
+    data = bot.session.data
+    if isinstance(data, dict):
+        return {key: value for key, value in data.items() if value != None}
+    if bot.session.headers.get('Content-Encoding') == 'gzip':
+        data = gzip.decompress(data)
+    return {key: value[0] for key, value in parse_qs(data.decode('utf-8'), keep_blank_values=True).items()}
+
+class SetObjectTest(unittest.TestCase):
+    def test_compressed_form_matches(self):
+        patient_obj = {'external_id': 'A1', 'gender': None, 'notes': '', 'weight': 12.5}
+        expected = {'property#external_id': 'A1', 'property#notes': '', 'property#weight': '12.5'}
+        self.assertEqual(put_form(True, patient_obj), expected)
+        patient_obj['notes'] = 'x' * PhenoTipsBot.MIN_COMPRESS_SIZE
+        expected['property#notes'] = patient_obj['notes']
+        self.assertEqual(put_form(True, patient_obj), expected)
+
+    def test_uncompressed_form(self):
+        patient_obj = {'external_id': 'A1', 'gender': None}
+        self.assertEqual(put_form(False, patient_obj), {'property#external_id': 'A1'})
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,67 @@
+# Startup time checks for PhenoTipsBot and the sample programs
+#
+# Copyright 2015 University of Utah
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301
+# USA
+
+import subprocess
+import sys
+import unittest
+from os.path import abspath
+from os.path import dirname
+
+ROOT = dirname(dirname(abspath(__file__)))
+#the programs that can be imported without running them; the others run as soon as they are loaded
+MODULES = ['phenotipsbot', 'import-csv', 'export-csv', 'export-clinvar']
+#only the functions that need these should load them, although some versions of requests load zstandard themselves
+LAZY_MODULES = ('selenium', 'dateutil', 'pyarrow', 'zstandard', 'PyQt5')
+BUDGET = 0.5 #seconds to import each module, not counting the interpreter's own startup
+
+def import_times(module):
+    #returns the cumulative import time in seconds of every module loaded by importing module in a fresh interpreter
+    code = '__import__(' + repr(module) + ')'
+    result = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', code],
+        cwd=ROOT, stderr=subprocess.PIPE, universal_newlines=True, check=True
+    )
+    times = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:'):
+            continue
+        self_time, cumulative_time, name = line[len('import time:'):].split('|')
+        if cumulative_time.strip().isdigit():
+            times[name.strip()] = int(cumulative_time) / 1000000
+    return times
+
+class StartupTest(unittest.TestCase):
+    def test_lazy_modules_not_imported(self):
+        #only count the modules that this repository loads, not the ones that its dependencies load on their own
+        dependency_modules = set(import_times('requests'))
+        for module in MODULES:
+            with self.subTest(module=module):
+                loaded = [
+                    name for name in import_times(module)
+                    if name.split('.')[0] in LAZY_MODULES and name not in dependency_modules
+                ]
+                self.assertEqual(loaded, [])
+
+    def test_import_time_budget(self):
+        for module in MODULES:
+            with self.subTest(module=module):
+                self.assertLess(import_times(module)[module], BUDGET)
+
+if __name__ == '__main__':
+    unittest.main()
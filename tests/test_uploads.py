@@ -0,0 +1,108 @@
+# Tests for uploading changed files with PhenoTipsBot
+#
+# Copyright 2016 University of Utah
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301
+# USA
+
+import json
+import sys
+import time
+import unittest
+from collections import Counter
+from os.path import abspath
+from os.path import basename
+from os.path import dirname
+from os.path import join
+from tempfile import TemporaryDirectory
+from threading import Lock
+
+sys.path.insert(0, dirname(dirname(abspath(__file__))))
+from phenotipsbot import PhenoTipsBot
+
+class FakeAttachmentBot(PhenoTipsBot):
+    #keeps the attachments in memory and records how often each patient's are listed and how many uploads overlap
+    def __init__(self):
+        super().__init__('http://localhost:8080', 'Admin', 'admin')
+        self.attachments = {}
+        self.list_counts = Counter()
+        self.uploading = Counter()
+        self.max_uploading = Counter()
+        self.lock = Lock()
+
+    def list_files(self, patient_id):
+        with self.lock:
+            self.list_counts[patient_id] += 1
+            return dict(self.attachments.get(patient_id, {}))
+
+    def upload_file(self, patient_id, filepath):
+        with self.lock:
+            self.uploading[patient_id] += 1
+            self.max_uploading[patient_id] = max(self.max_uploading[patient_id], self.uploading[patient_id])
+        time.sleep(0.01)
+        with open(filepath, 'rb') as fd:
+            size = len(fd.read())
+        with self.lock:
+            self.uploading[patient_id] -= 1
+            attachments = self.attachments.setdefault(patient_id, {})
+            previous = attachments.get(basename(filepath))
+            version = str(int(previous['version'].split('.')[0]) + 1) + '.1' if previous else '1.1'
+            attachments[basename(filepath)] = {'size': size, 'version': version}
+
+class UploadChangedFilesTest(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = TemporaryDirectory()
+        self.manifest_path = join(self.temp_dir.name, 'manifest.json')
+        self.transfers = []
+        for patient_id in ('P0000001', 'P0000002'):
+            for i in range(4):
+                filepath = join(self.temp_dir.name, patient_id + '-' + str(i) + '.vcf')
+                with open(filepath, 'w') as fd:
+                    fd.write('#' + str(i) + '\n')
+                self.transfers.append((patient_id, filepath))
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def test_one_patient_at_a_time(self):
+        bot = FakeAttachmentBot()
+        self.assertEqual(bot.upload_changed_files(self.transfers, self.manifest_path), [True] * 8)
+        self.assertEqual(bot.max_uploading, Counter({'P0000001': 1, 'P0000002': 1}))
+        #once before the uploads and once after them to learn the new versions
+        self.assertEqual(bot.list_counts, Counter({'P0000001': 2, 'P0000002': 2}))
+        with open(self.manifest_path) as manifest_file:
+            manifest = json.load(manifest_file)
+        self.assertEqual(manifest['P0000001/P0000001-0.vcf']['version'], '1.1')
+
+    def test_unchanged_files_skipped(self):
+        bot = FakeAttachmentBot()
+        bot.upload_changed_files(self.transfers, self.manifest_path)
+        bot.list_counts.clear()
+        self.assertEqual(bot.upload_changed_files(self.transfers, self.manifest_path), [False] * 8)
+        self.assertEqual(bot.list_counts, Counter({'P0000001': 1, 'P0000002': 1}))
+
+        #a file replaced on the server is uploaded again
+        bot.attachments['P0000002']['P0000002-3.vcf']['version'] = '5.1'
+        results = bot.upload_changed_files(self.transfers, self.manifest_path)
+        self.assertEqual(results, [False] * 7 + [True])
+
+    def test_upload_files(self):
+        bot = FakeAttachmentBot()
+        bot.upload_files(self.transfers)
+        self.assertEqual(bot.max_uploading, Counter({'P0000001': 1, 'P0000002': 1}))
+        self.assertEqual(len(bot.attachments['P0000001']), 4)
+
+if __name__ == '__main__':
+    unittest.main()
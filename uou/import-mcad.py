@@ -30,6 +30,7 @@ from sys import stdout
 
 sys.path.append(os.path.dirname(__file__) + '/..')
 from phenotipsbot import PhenoTipsBot
+from phenotipsbot import map_concurrently
 
 #parse arguments
 
@@ -159,7 +160,7 @@ if not password:
 bot = PhenoTipsBot(base_url, username, password)
 
 if study == None:
-    studies = bot.list_studies()
+    studies = bot.list_directory()['studies']
     if len(studies):
         print('Available study forms:')
         print('* ' + '\n* '.join(studies))
@@ -170,12 +171,14 @@ elif study == 'None':
 #begin import
 
 if yes or input('You are about to import ' + str(len(patients)) + ' patients. Type y to continue: ')[0] == 'y':
+    def import_patient(patient, clinvar_variants):
+        patient_id = bot.create(patient, study)
+        bot.create_objects(patient_id, [('PhenoTips.ClinVarVariantClass', clinvar_variant) for clinvar_variant in clinvar_variants])
+        return patient_id
+
     count = 0
     start_time = time.time()
-    for patient, clinvar_variants in patients:
-        patient_id = bot.create(patient, study)
-        for clinvar_variant in clinvar_variants:
-            bot.create_object(patient_id, 'PhenoTips.ClinVarVariantClass', clinvar_variant)
+    for patient_id in map_concurrently(lambda patient: import_patient(*patient), patients):
         count += 1
         stdout.write(str(count) + '\r')
     print()